@@ -0,0 +1,83 @@
+"""
+Load test for the /chat-response endpoint.
+
+Sends the same questions to the API Gateway + Lambda endpoint or to a local
+server started with infra/backend/server.py, and reports throughput and
+latency percentiles so the two can be compared.
+
+Usage:
+    # API Gateway + Lambda, endpoint and key read from config.yaml
+    python3 benchmarks/bench_chat_load.py --requests 200 --concurrency 20
+
+    # Local server
+    python3 benchmarks/bench_chat_load.py --url http://localhost:8080/
+"""
+
+import argparse
+import os
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+import yaml
+
+QUESTIONS = [
+    "How do I reset my password?",
+    "How do I connect to the campus VPN?",
+    "Where can I find my class schedule?",
+    "How do I set up multi-factor authentication?",
+    "Who do I contact for software licensing?",
+]
+
+
+def percentile(values, share):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(share * len(values)))]
+
+
+def main():
+    config_path = os.path.join(os.path.dirname(__file__), "..", "config.yaml")
+    config = {}
+    if os.path.exists(config_path):
+        config = yaml.safe_load(open(config_path))
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--url", default=config.get("rag_api_endpoint"))
+    parser.add_argument("--api-key", default=config.get("api_key"))
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=10)
+    args = parser.parse_args()
+
+    api_url = args.url.rstrip("/") + "/chat-response"
+    headers = {"x-api-key": args.api_key} if args.api_key else {}
+
+    # Connections are pooled and kept alive, as a long-lived frontend would
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=args.concurrency)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    def send(i):
+        start = time.perf_counter()
+        response = session.post(
+            api_url, json={"query": QUESTIONS[i % len(QUESTIONS)]}, headers=headers
+        )
+        return response.status_code, (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(send, range(args.requests)))
+    elapsed = time.perf_counter() - start
+
+    latencies = [ms for _, ms in results]
+    print(f"url:         {api_url}")
+    print(f"requests:    {args.requests} at concurrency {args.concurrency}")
+    print(f"status:      {dict(Counter(status for status, _ in results))}")
+    print(f"throughput:  {args.requests / elapsed:.1f} req/s")
+    for name, share in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99)):
+        print(f"{name}:         {percentile(latencies, share):.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+"""
+Benchmark for document chunking on multi-megabyte markdown.
+
+Times chunking.mark_document_chunks and stream_document_chunks against the
+previous implementation, whose search for the end of an image tag ran to the
+end of the text, on typical extracted markdown and on markdown with unclosed
+image tags. Before timing, checks on randomized documents that all three
+produce the same chunks, byte for byte, for random chunk sizes, overlaps and
+stream splits.
+
+Usage:
+    python3 benchmarks/bench_chunking.py
+    python3 benchmarks/bench_chunking.py --size-mb 20 --trials 5000
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), "..", "infra", "lambda_ingest")
+)
+
+from chunking import mark_document_chunks, stream_document_chunks  # noqa: E402
+
+WORDS = (
+    "the of and to in is that for it as was with be by on not this are or from "
+    "at which have an they you were there would their has when who will more "
+    "network password account campus student faculty server access request"
+).split()
+
+# Fragments random documents are built from, weighted towards the edge cases
+TOKENS = ["word", "a", "longerword", " ", " ", " ", ". ", "! ", "? ", "\n", "\n\n"]
+TOKENS += ["![", ")", "(s3://b/i.png)", "[desc]", ".", "x" * 50]
+
+
+def scan_document_chunks(markdown_text, n=3000, overlap=600):
+    """The chunker before its image tag search was bounded, as the reference."""
+    if not markdown_text:
+        return []
+
+    chunks = []
+    current_position = 0
+    total_length = len(markdown_text)
+
+    if n <= overlap:
+        n = overlap * 2
+
+    while current_position < total_length:
+        chunk_end = min(current_position + n, total_length)
+
+        if chunk_end < total_length:
+            img_start = markdown_text.rfind("![", current_position, chunk_end)
+            if img_start != -1:
+                img_end = markdown_text.find(")", img_start)
+                if img_end == -1 or img_end >= chunk_end:
+                    if img_end != -1 and img_end < current_position + n * 1.5:
+                        chunk_end = img_end + 1
+                    else:
+                        chunk_end = img_start
+
+            if chunk_end < total_length:
+                paragraph_break = markdown_text.rfind(
+                    "\n\n", current_position, chunk_end
+                )
+                if paragraph_break != -1 and paragraph_break > current_position + (
+                    n // 4
+                ):
+                    chunk_end = paragraph_break + 2
+                else:
+                    line_break = markdown_text.rfind("\n", current_position, chunk_end)
+                    if line_break != -1 and line_break > current_position + (n // 4):
+                        chunk_end = line_break + 1
+                    else:
+                        sentence_end = max(
+                            markdown_text.rfind(". ", current_position, chunk_end),
+                            markdown_text.rfind("! ", current_position, chunk_end),
+                            markdown_text.rfind("? ", current_position, chunk_end),
+                        )
+                        if sentence_end != -1 and sentence_end > current_position + (
+                            n // 4
+                        ):
+                            chunk_end = sentence_end + 2
+                        else:
+                            space = markdown_text.rfind(
+                                " ", current_position, chunk_end
+                            )
+                            if space != -1 and space > current_position + (n // 4):
+                                chunk_end = space + 1
+
+        chunks.append(markdown_text[current_position:chunk_end])
+
+        next_position = chunk_end - overlap
+        if next_position <= current_position:
+            next_position = current_position + max(n // 2, 1)
+        current_position = min(next_position, total_length)
+
+    return chunks
+
+
+def make_markdown(size, rng, unclosed_images=False):
+    """
+    Builds markdown shaped like extracted PDF text: short lines, sentences,
+    paragraphs and image descriptions. With unclosed_images, every image
+    tag is left open, so only the last one in the text is ever closed.
+    """
+    image = "![a chart of weekly ticket volume" + ("" if unclosed_images else ")")
+    parts = []
+    length = 0
+    while length < size:
+        r = rng.random()
+        if r < 0.02:
+            part = "\n\n"
+        elif r < 0.1:
+            part = "\n"
+        elif r < 0.11:
+            part = image + "\n"
+        elif r < 0.2:
+            part = ". "
+        else:
+            part = rng.choice(WORDS) + " "
+        parts.append(part)
+        length += len(part)
+    return "".join(parts) + ")"
+
+
+def split_randomly(text, rng, pieces):
+    """Cuts text into up to `pieces` consecutive pieces at random offsets."""
+    cuts = sorted(rng.sample(range(len(text) + 1), min(len(text) + 1, pieces)))
+    return [text[start:end] for start, end in zip([0] + cuts, cuts + [len(text)])]
+
+
+def check_equivalence(trials, rng):
+    for trial in range(trials):
+        text = "".join(rng.choice(TOKENS) for _ in range(rng.randint(0, 600)))
+        n = rng.randint(1, 400)
+        overlap = rng.randint(0, 300)
+
+        expected = scan_document_chunks(text, n, overlap)
+        assert mark_document_chunks(text, n, overlap) == expected, (
+            f"mark_document_chunks differs on trial {trial}"
+        )
+        pieces = split_randomly(text, rng, rng.randint(0, 40))
+        assert list(stream_document_chunks(pieces, n, overlap)) == expected, (
+            f"stream_document_chunks differs on trial {trial}"
+        )
+    print(f"{trials} randomized documents chunked identically\n")
+
+
+def best_time(function, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size-mb", type=float, default=5)
+    parser.add_argument("--trials", type=int, default=2000)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--chunk-size", type=int, default=3000)
+    parser.add_argument("--overlap", type=int, default=600)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    check_equivalence(args.trials, rng)
+
+    size = int(args.size_mb * 1024 * 1024)
+    n, overlap = args.chunk_size, args.overlap
+    print(
+        f"{'document':<18} {'chunks':>7} {'scan (ms)':>10} {'mark (ms)':>10} "
+        f"{'stream (ms)':>12}"
+    )
+    for name, unclosed in (("typical", False), ("unclosed images", True)):
+        text = make_markdown(size, rng, unclosed)
+        lines = text.split("\n")
+        pieces = [line + "\n" for line in lines[:-1]] + lines[-1:]
+
+        chunks = mark_document_chunks(text, n, overlap)
+        assert chunks == scan_document_chunks(text, n, overlap)
+        assert list(stream_document_chunks(pieces, n, overlap)) == chunks
+
+        scan_s = best_time(lambda: scan_document_chunks(text, n, overlap), args.repeats)
+        mark_s = best_time(lambda: mark_document_chunks(text, n, overlap), args.repeats)
+        stream_s = best_time(
+            lambda: sum(1 for _ in stream_document_chunks(pieces, n, overlap)),
+            args.repeats,
+        )
+        print(
+            f"{name:<18} {len(chunks):>7} {scan_s * 1000:>10.1f} "
+            f"{mark_s * 1000:>10.1f} {stream_s * 1000:>12.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""
+Benchmark for hybrid result fusion as candidate depth grows.
+
+Times search_utils.fuse_results against the previous dict based
+implementation for increasing result list sizes and top_K values, and checks
+both produce the same ranking on the min-max path.
+
+Usage:
+    python3 benchmarks/bench_fusion.py
+"""
+
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "infra", "backend"))
+
+from search_utils import fuse_results, hybrid_search  # noqa: E402
+
+import numpy as np  # noqa: E402
+
+SIZES = [10, 50, 100, 250, 500, 1000]
+REPEATS = 50
+
+
+def dict_hybrid_search(top_K_results, lexical_results, semantic_results, alpha=0.5):
+    """The per-hit dict implementation hybrid_search used before fuse_results."""
+
+    def minmax(scores):
+        scores = np.array(scores)
+        return (scores - np.min(scores)) / (np.max(scores) - np.min(scores))
+
+    lexical_hits = lexical_results["hits"]["hits"]
+    semantic_hits = semantic_results["hits"]["hits"]
+    lexical_docs = {
+        hit["_id"]: (hit, score)
+        for hit, score in zip(
+            lexical_hits, minmax([h["_score"] for h in lexical_hits])
+        )
+    }
+    semantic_docs = {
+        hit["_id"]: (hit, score)
+        for hit, score in zip(
+            semantic_hits, minmax([h["_score"] for h in semantic_hits])
+        )
+    }
+
+    combined_results = []
+    for doc_id in set(lexical_docs.keys()) | set(semantic_docs.keys()):
+        lexical_hit, lexical_score = lexical_docs.get(doc_id, (None, 0))
+        semantic_hit, semantic_score = semantic_docs.get(doc_id, (None, 0))
+        if lexical_hit and semantic_hit:
+            score = alpha * lexical_score + (1 - alpha) * semantic_score
+            hit = lexical_hit
+        elif lexical_hit:
+            score, hit = lexical_score, lexical_hit
+        else:
+            score, hit = semantic_score, semantic_hit
+        combined_results.append(
+            {"_id": doc_id, "_source": {**hit["_source"]}, "_score": score}
+        )
+    combined_results = sorted(
+        combined_results, key=lambda h: h["_score"], reverse=True
+    )
+    return {"hits": {"hits": combined_results[:top_K_results]}}
+
+
+def make_results(size, id_space, rng):
+    """Builds a fake OpenSearch response with `size` distinct hits."""
+    ids = rng.sample(range(id_space), size)
+    hits = [
+        {
+            "_id": f"doc-{i}",
+            "_source": {"passage": "", "source_url": ""},
+            "_score": rng.random() * 10,
+        }
+        for i in ids
+    ]
+    hits.sort(key=lambda h: h["_score"], reverse=True)
+    return {"hits": {"hits": hits}}
+
+
+def main():
+    rng = random.Random(0)
+    print(
+        f"{'size':>6} {'top_K':>6} {'dict (ms)':>10} {'fuse (ms)':>10} "
+        f"{'rrf x3 (ms)':>12}"
+    )
+    for size in SIZES:
+        lexical = make_results(size, size * 2, rng)
+        semantic = make_results(size, size * 2, rng)
+        third = make_results(size, size * 2, rng)
+        top_k = size * 2
+
+        # Tie order differs between the two, so compare the score of every hit
+        expected = {
+            h["_id"]: round(h["_score"], 9)
+            for h in dict_hybrid_search(top_k, lexical, semantic)["hits"]["hits"]
+        }
+        actual = {
+            h["_id"]: round(h["_score"], 9)
+            for h in hybrid_search(top_k, lexical, semantic)["hits"]["hits"]
+        }
+        assert expected == actual, f"fused scores differ at size {size}"
+
+        dict_ms = timeit.timeit(
+            lambda: dict_hybrid_search(top_k, lexical, semantic), number=REPEATS
+        )
+        fuse_ms = timeit.timeit(
+            lambda: hybrid_search(top_k, lexical, semantic), number=REPEATS
+        )
+        rrf_ms = timeit.timeit(
+            lambda: fuse_results(
+                [lexical, semantic, third], normalizer="rrf", top_K_results=top_k
+            ),
+            number=REPEATS,
+        )
+        print(
+            f"{size:>6} {top_k:>6} {dict_ms * 1000 / REPEATS:>10.3f} "
+            f"{fuse_ms * 1000 / REPEATS:>10.3f} {rrf_ms * 1000 / REPEATS:>12.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Import-time report for the Lambda handler modules.
+
+Imports each handler in a fresh interpreter with `python -X importtime`,
+several times, and prints the median total import time along with the
+heaviest packages it pulled in. The import graph is what a cold start pays
+before the handler runs.
+
+Usage:
+    python3 benchmarks/import_time.py
+    python3 benchmarks/import_time.py --runs 10 --top 8
+"""
+
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+HANDLERS = [
+    ("infra/backend", "chatbot_backend"),
+    ("infra/backend", "chat_stream"),
+    ("infra/backend", "chat_async"),
+    ("infra/lambda_ingest", "document_pipeline"),
+]
+
+LINE_PATTERN = re.compile(r"import time:\s+\d+ \|\s+(\d+) \|( *)(\S+)")
+
+
+def measure(directory, module):
+    """
+    Imports `module` once in a new interpreter.
+
+    Returns:
+        dict: Cumulative microseconds per top-level package, with the total
+            under the module's own name
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=os.path.join(ROOT, directory),
+        env={**os.environ, "AWS_REGION": os.getenv("AWS_REGION", "us-west-2")},
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+
+    lines = [
+        (int(match[1]), len(match[2]), match[3])
+        for match in map(LINE_PATTERN.match, result.stderr.splitlines())
+        if match
+    ]
+
+    # Lines are printed after each import finishes, so the module's own
+    # imports are the lines just above it, back to the previous interpreter
+    # startup import at the same depth
+    end = next(i for i, line in enumerate(lines) if line[2] == module)
+    start = end
+    while start > 0 and lines[start - 1][1] > lines[end][1]:
+        start -= 1
+
+    # A top-level package is reported once, when it is first imported, with
+    # the time of everything it imported in turn
+    packages = {
+        name: cumulative
+        for cumulative, _, name in lines[start:end]
+        if "." not in name
+    }
+    packages[module] = lines[end][0]
+    return packages
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=6)
+    args = parser.parse_args()
+
+    for directory, module in HANDLERS:
+        try:
+            runs = [measure(directory, module) for _ in range(args.runs)]
+        except RuntimeError as e:
+            print(f"{module}: not importable here ({e})\n")
+            continue
+
+        medians = {
+            name: statistics.median(run.get(name, 0) for run in runs)
+            for name in runs[0]
+        }
+        total = medians.pop(module)
+        print(f"{module}: {total / 1000:.1f} ms (median of {args.runs})")
+        heaviest = sorted(medians.items(), key=lambda item: item[1], reverse=True)
+        for name, us in heaviest[: args.top]:
+            print(f"    {name:<24} {us / 1000:>8.1f} ms")
+        print()
+
+
+if __name__ == "__main__":
+    main()
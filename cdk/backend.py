@@ -3,6 +3,8 @@ from aws_cdk import (
     Stack,
     aws_lambda as _lambda,
     aws_apigateway as apigw,
+    aws_apigatewayv2 as apigwv2,
+    aws_apigatewayv2_integrations as apigwv2_integrations,
     aws_iam as iam,
     aws_opensearchserverless as aws_opss,
     Duration,
@@ -10,6 +12,7 @@ from aws_cdk import (
     CfnOutput,
     Fn,
     aws_s3 as s3,
+    aws_dynamodb as dynamodb,
     aws_s3_deployment as s3deploy,
     RemovalPolicy,
 )
@@ -184,6 +187,9 @@ class RagBackendStack(Stack):
                 "OPENSEARCH_ENDPOINT": opensearch_endpoint,
                 "CHUNK_SIZE": config["chunk_size"],
                 "OVERLAP": config["overlap"],
+                "CHUNKING_MODE": config.get("chunking_mode", "characters"),
+                "IMAGE_CONCURRENCY": config.get("image_concurrency", "4"),
+                "IMAGE_CACHE_PREFIX": config.get("image_cache_folder", "image_cache/"),
             },
         )
 
@@ -213,38 +219,80 @@ class RagBackendStack(Stack):
         # CDK FOR THE LAMBDA WHICH SERVES THE API
         #################################################################################
 
+        answer_cache_config = config.get("answer_cache", {})
+        conversation_config = config.get("conversation", {})
+
+        # Turn history for multi-turn sessions, expired by DynamoDB TTL
+        conversation_table = dynamodb.Table(
+            self,
+            "ConversationTable",
+            partition_key=dynamodb.Attribute(
+                name="session_id", type=dynamodb.AttributeType.STRING
+            ),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            time_to_live_attribute="expires_at",
+            removal_policy=RemovalPolicy.DESTROY,
+        )
+
+        chat_lambda_code = _lambda.Code.from_asset(
+            "../infra/backend",
+            bundling=BundlingOptions(
+                image=_lambda.Runtime.PYTHON_3_11.bundling_image,
+                command=[
+                    "bash",
+                    "-c",
+                    "pip install -r requirements.txt -t /asset-output && cp -au . /asset-output",
+                ],
+            ),
+        )
+
+        chat_environment = {
+            "OPENSEARCH_ENDPOINT": opensearch_endpoint,
+            "OPENSEARCH_INDEX": config["opensearch_index_name"],
+            "CHAT_MODEL_ID": config["model"]["chat"],
+            "EMBEDDING_MODEL_ID": config["model"]["embedding"],
+            "CHAT_PROMPT": config["chat_prompt"],
+            "ANSWER_CACHE_ENABLED": answer_cache_config.get("enabled", "false"),
+            "ANSWER_CACHE_MAX_DISTANCE": answer_cache_config.get(
+                "max_distance", "0.05"
+            ),
+            "ANSWER_CACHE_TTL": answer_cache_config.get("ttl", "3600"),
+            "RETRIEVAL_MODE": config.get("retrieval_mode", "client"),
+            "SEARCH_PIPELINE": config.get(
+                "search_pipeline_name", "hybrid-search-pipeline"
+            ),
+            "RERANKER": config.get("reranker", "none"),
+            "RERANK_MODEL_ID": config["model"].get("rerank", "amazon.rerank-v1:0"),
+            "CONVERSATION_TABLE": conversation_table.table_name,
+            "CONVERSATION_TTL": conversation_config.get("ttl", "3600"),
+            "CONVERSATION_MAX_TURNS": conversation_config.get("max_turns", "4"),
+            "CONVERSATION_REUSE_SIMILARITY": conversation_config.get(
+                "reuse_similarity", "0.85"
+            ),
+        }
+
         # Define the Lambda function
         chat_lambda = _lambda.Function(
             self,
             "ChatbotConversationHandler",
             runtime=_lambda.Runtime.PYTHON_3_11,
-            code=_lambda.Code.from_asset(
-                "../infra/backend",
-                bundling=BundlingOptions(
-                    image=_lambda.Runtime.PYTHON_3_11.bundling_image,
-                    command=[
-                        "bash",
-                        "-c",
-                        "pip install -r requirements.txt -t /asset-output && cp -au . /asset-output",
-                    ],
-                ),
+            code=chat_lambda_code,
+            handler=(
+                "chat_async.lambda_handler"
+                if config.get("chat_handler", "sync") == "async"
+                else "chatbot_backend.lambda_handler"
             ),
-            handler="chatbot_backend.lambda_handler",
             timeout=Duration.seconds(60),
-            environment={
-                "OPENSEARCH_ENDPOINT": opensearch_endpoint,
-                "OPENSEARCH_INDEX": config["opensearch_index_name"],
-                "CHAT_MODEL_ID": config["model"]["chat"],
-                "EMBEDDING_MODEL_ID": config["model"]["embedding"],
-                "CHAT_PROMPT": config["chat_prompt"],
-            },
+            environment=chat_environment,
         )
 
-        chat_lambda.add_to_role_policy(iam.PolicyStatement(
+        chat_s3_policy = iam.PolicyStatement(
             actions=["s3:GetObject"],
             resources=[f"arn:aws:s3:::{config['input_bucket_name']}/*"],
             effect=iam.Effect.ALLOW
-        ))
+        )
+        chat_lambda.add_to_role_policy(chat_s3_policy)
+        conversation_table.grant_read_write_data(chat_lambda)
 
         # Attach AWS managed policies
         chat_lambda.role.add_managed_policy(
@@ -337,6 +385,74 @@ class RagBackendStack(Stack):
         usage_plan.add_api_key(api_key)
         usage_plan.add_api_stage(stage=api.deployment_stage)
 
+        #################################################################################
+        # CDK FOR THE STREAMING WEBSOCKET API
+        #################################################################################
+
+        # Same code and environment as the REST handler, streamed over a WebSocket
+        stream_lambda = _lambda.Function(
+            self,
+            "ChatbotStreamHandler",
+            runtime=_lambda.Runtime.PYTHON_3_11,
+            code=chat_lambda_code,
+            handler="chat_stream.lambda_handler",
+            timeout=Duration.seconds(120),
+            environment=chat_environment,
+        )
+
+        stream_lambda.add_to_role_policy(chat_s3_policy)
+        conversation_table.grant_read_write_data(stream_lambda)
+        stream_lambda.role.add_managed_policy(
+            iam.ManagedPolicy.from_aws_managed_policy_name("AmazonBedrockFullAccess")
+        )
+        stream_lambda.role.add_to_policy(opensearch_policy)
+
+        stream_integration = apigwv2_integrations.WebSocketLambdaIntegration(
+            "StreamIntegration", stream_lambda
+        )
+
+        websocket_api = apigwv2.WebSocketApi(
+            self,
+            "RagWebSocketAPI",
+            api_name="RagChatbotStreamAPI",
+            description="WebSocket API streaming chat responses from a lambda",
+            api_key_selection_expression=apigwv2.WebSocketApiKeySelectionExpression.HEADER_X_API_KEY,
+            disconnect_route_options=apigwv2.WebSocketRouteOptions(
+                integration=stream_integration
+            ),
+            default_route_options=apigwv2.WebSocketRouteOptions(
+                integration=stream_integration
+            ),
+        )
+
+        # The API key is checked once, when the connection is opened
+        apigwv2.WebSocketRoute(
+            self,
+            "RagWebSocketConnectRoute",
+            web_socket_api=websocket_api,
+            route_key="$connect",
+            integration=stream_integration,
+            api_key_required=True,
+        )
+
+        websocket_stage = apigwv2.WebSocketStage(
+            self,
+            "RagWebSocketStage",
+            web_socket_api=websocket_api,
+            stage_name="prod",
+            auto_deploy=True,
+        )
+
+        websocket_api.grant_manage_connections(stream_lambda)
+
+        # UsagePlan.add_api_stage only accepts REST stages, so add the WebSocket stage directly
+        usage_plan.node.default_child.add_property_override(
+            "ApiStages.1",
+            {"ApiId": websocket_api.api_id, "Stage": websocket_stage.stage_name},
+        )
+        # stage_name is a plain string, so the stage must be created first explicitly
+        usage_plan.node.add_dependency(websocket_stage)
+
         # Output the API URL, API Key, Opensearch endpoint
         CfnOutput(
             self,
@@ -351,3 +467,10 @@ class RagBackendStack(Stack):
             value=opensearch_endpoint,
             export_name="RagBackendStack-OpensearchAPIEndpoint",
         )
+
+        CfnOutput(
+            self,
+            "RagWebSocketEndpoint",
+            value=websocket_stage.url,
+            export_name="RagBackendStack-RagWebSocketEndpoint",
+        )
@@ -1,11 +1,16 @@
 import streamlit as st
 import requests
+import json
+import uuid
 import yaml
+from websocket import create_connection
 
 config = yaml.safe_load(open("./config.yaml"))
 
 API_URL = config["rag_api_endpoint"] + "chat-response"
 API_KEY = config["api_key"]
+# Stream answers over the WebSocket API when its endpoint is configured
+WS_URL = config.get("rag_ws_endpoint")
 
 
 def display_response(raw_text: str):
@@ -14,6 +19,24 @@ def display_response(raw_text: str):
     st.markdown(decoded_text)
 
 
+def stream_response(query: str, session_id: str):
+    """Yields answer text from the WebSocket API as it is generated."""
+    ws = create_connection(WS_URL, header=[f"x-api-key: {API_KEY}"])
+    try:
+        ws.send(json.dumps({"query": query, "session_id": session_id}))
+        while True:
+            message = json.loads(ws.recv())
+            if message["type"] == "delta":
+                yield message["text"]
+            elif message["type"] == "error":
+                yield f"Error: {message['text']}"
+                break
+            else:
+                break
+    finally:
+        ws.close()
+
+
 # Streamlit App Setup
 st.set_page_config(page_title="Serveless Rag Chatbot PoC", page_icon="💬")
 st.title("RAG Serverless Framework")
@@ -22,6 +45,10 @@ st.title("RAG Serverless Framework")
 if "messages" not in st.session_state:
     st.session_state.messages = []
 
+# Lets the backend keep the conversation history for follow-up questions
+if "session_id" not in st.session_state:
+    st.session_state.session_id = str(uuid.uuid4())
+
 # Display the chat messages
 for msg in st.session_state.messages:
     role = "You" if msg["role"] == "user" else "Bot"
@@ -39,16 +66,30 @@ if user_input:
         display_response(user_input)
 
     # Send to API
-    headers = {"x-api-key": API_KEY}
-    data = {"query": user_input}
-    try:
-        response = requests.post(API_URL, json=data, headers=headers)
-        response.raise_for_status()
-        bot_reply = response.text
-    except Exception as e:
-        bot_reply = f"Error: {e}"
-
-    # Add bot response to history
-    st.session_state.messages.append({"role": "assistant", "content": bot_reply})
-    with st.chat_message("assistant"):
-        display_response(bot_reply)
+    if WS_URL:
+        with st.chat_message("assistant"):
+            try:
+                streamed_reply = st.write_stream(
+                    stream_response(user_input, st.session_state.session_id)
+                )
+            except Exception as e:
+                streamed_reply = f"Error: {e}"
+                st.markdown(streamed_reply)
+        # Store the reply JSON encoded, the same way the REST API returns it
+        st.session_state.messages.append(
+            {"role": "assistant", "content": json.dumps(streamed_reply)}
+        )
+    else:
+        headers = {"x-api-key": API_KEY}
+        data = {"query": user_input, "session_id": st.session_state.session_id}
+        try:
+            response = requests.post(API_URL, json=data, headers=headers)
+            response.raise_for_status()
+            bot_reply = response.text
+        except Exception as e:
+            bot_reply = f"Error: {e}"
+
+        # Add bot response to history
+        st.session_state.messages.append({"role": "assistant", "content": bot_reply})
+        with st.chat_message("assistant"):
+            display_response(bot_reply)
@@ -0,0 +1,180 @@
+"""
+Semantic cache of final chat answers.
+
+A new query reuses a cached answer when its embedding is within a configured
+cosine distance of a recently answered query and retrieval returned the same
+documents, which lets FAQ-style traffic skip the chat model entirely.
+"""
+
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+logger = logging.getLogger()
+
+
+class NumpyVectorStore:
+    """
+    Reference vector store holding unit vectors as rows of a NumPy matrix.
+    Any store exposing add/remove/search/clear can back the answer cache.
+    """
+
+    def __init__(self):
+        self._keys = []
+        self._rows = {}
+        self._matrix = None
+
+    def __len__(self):
+        return len(self._keys)
+
+    def add(self, key, vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        vector = vector / (np.linalg.norm(vector) or 1.0)
+        if key in self._rows:
+            self._matrix[self._rows[key]] = vector
+            return
+        if self._matrix is None:
+            self._matrix = vector[np.newaxis, :]
+        else:
+            self._matrix = np.vstack([self._matrix, vector])
+        self._rows[key] = len(self._keys)
+        self._keys.append(key)
+
+    def remove(self, key):
+        row = self._rows.pop(key, None)
+        if row is None:
+            return
+        # Move the last row into the freed slot to keep the matrix dense
+        last = len(self._keys) - 1
+        if row != last:
+            self._matrix[row] = self._matrix[last]
+            self._keys[row] = self._keys[last]
+            self._rows[self._keys[row]] = row
+        self._keys.pop()
+        self._matrix = self._matrix[:last] if last else None
+
+    def search(self, vector, k=3):
+        """Returns up to k (key, cosine distance) pairs, closest first."""
+        if not self._keys:
+            return []
+        vector = np.asarray(vector, dtype=np.float32)
+        vector = vector / (np.linalg.norm(vector) or 1.0)
+        distances = 1.0 - self._matrix @ vector
+        k = min(k, len(self._keys))
+        nearest = np.argpartition(distances, k - 1)[:k]
+        nearest = nearest[np.argsort(distances[nearest])]
+        return [(self._keys[i], float(distances[i])) for i in nearest]
+
+    def clear(self):
+        self._keys = []
+        self._rows = {}
+        self._matrix = None
+
+
+class AnswerCache:
+    """
+    TTL and size bounded cache of model answers keyed by query embedding.
+
+    :param store: Vector store used to find nearby cached queries.
+    :param max_distance: Largest cosine distance still treated as the same question.
+    :param ttl: Seconds a cached answer stays valid.
+    :param max_entries: Maximum number of cached answers.
+    """
+
+    def __init__(self, store, max_distance=0.05, ttl=3600, max_entries=512):
+        self.store = store
+        self.max_distance = max_distance
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.index_version = None
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._next_key = 0
+        self._lock = threading.Lock()
+
+    def _check_index_version(self, index_version):
+        # Entries built against an older index may cite stale passages
+        if index_version != self.index_version:
+            if self._entries:
+                logger.info("Index changed, invalidating answer cache")
+            self._entries.clear()
+            self.store.clear()
+            self.index_version = index_version
+
+    def lookup(self, embedding, doc_ids, index_version=None):
+        """
+        Finds a cached answer for a query.
+
+        Args:
+            embedding (list): The query embedding
+            doc_ids (list): IDs of the documents retrieved for the query
+            index_version: Token that changes whenever the index does
+
+        Returns:
+            dict: The cached entry, or None on a miss
+        """
+        now = time.time()
+        with self._lock:
+            self._check_index_version(index_version)
+            for key, distance in self.store.search(embedding):
+                if distance > self.max_distance:
+                    break
+                entry = self._entries[key]
+                if entry["expires_at"] < now:
+                    self._remove(key)
+                    continue
+                if entry["doc_ids"] == frozenset(doc_ids):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry
+            self.misses += 1
+            return None
+
+    def put(self, embedding, doc_ids, answer, source_mapping, index_version=None):
+        """Stores the raw model answer and the source mapping it cites."""
+        with self._lock:
+            self._check_index_version(index_version)
+            key = self._next_key
+            self._next_key += 1
+            self._entries[key] = {
+                "doc_ids": frozenset(doc_ids),
+                "answer": answer,
+                "source_mapping": source_mapping,
+                "expires_at": time.time() + self.ttl,
+            }
+            self.store.add(key, embedding)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self):
+        """Drops every cached answer."""
+        with self._lock:
+            self._entries.clear()
+            self.store.clear()
+
+    def _remove(self, key):
+        self._entries.pop(key, None)
+        self.store.remove(key)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._entries),
+            }
+
+
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "false").lower() == "true"
+
+answer_cache = AnswerCache(
+    NumpyVectorStore(),
+    max_distance=float(os.getenv("ANSWER_CACHE_MAX_DISTANCE", "0.05")),
+    ttl=int(os.getenv("ANSWER_CACHE_TTL", "3600")),
+    max_entries=int(os.getenv("ANSWER_CACHE_SIZE", "512")),
+)
@@ -0,0 +1,519 @@
+"""
+Asyncio version of the chat request path.
+
+Embedding, both OpenSearch legs, presigning and the Bedrock call are
+coroutines on one event loop, using aiobotocore and AsyncOpenSearch clients
+shared by every request on that loop. lambda_handler has the same signature
+and contract as chatbot_backend.lambda_handler, and handle_chat can be
+awaited directly from an ASGI server so one process serves many requests
+concurrently.
+
+Retrieval settings, prompt building, answer and embedding caches and
+conversation memory are shared with the synchronous path.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import time
+import weakref
+from contextlib import AsyncExitStack
+from urllib.parse import urlparse
+
+from aiobotocore.config import AioConfig
+from aiobotocore.session import get_session as get_aio_session
+from opensearchpy import AsyncHttpConnection, AsyncOpenSearch, AWSV4SignerAsyncAuth
+from opensearchpy.exceptions import NotFoundError, RequestError
+
+from answer_cache import ANSWER_CACHE_ENABLED, answer_cache
+from chatbot_backend import (
+    LINK_PATTERN,
+    build_prompt,
+    cache_presigned_url,
+    get_cached_presigned_url,
+    process_text,
+)
+from clients import MAX_POOL_CONNECTIONS, get_session
+from conversation import (
+    format_history,
+    load_session,
+    record_turn,
+    reusable_documents,
+    rewrite_query,
+    save_session,
+)
+from embedding_cache import cache_key, embedding_cache
+from opensearch_query import (
+    INDEX_VERSION_TTL,
+    RETRIEVAL_INITIAL_SIZE,
+    RETRIEVAL_MAX_SIZE,
+    SEARCH_PIPELINE,
+    _index_version,
+    _pipeline_available,
+    is_flat,
+    select_top_documents,
+)
+from rerank import get_reranker, rerank_results
+from search_utils import hybrid_search
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+aio_config = AioConfig(
+    max_pool_connections=MAX_POOL_CONNECTIONS,
+    retries={"max_attempts": 3, "mode": "standard"},
+)
+
+# Async clients are bound to the loop that created them, so each loop
+# (the Lambda loop below, or one per ASGI worker) keeps its own set
+_loop_clients = weakref.WeakKeyDictionary()
+
+
+def _clients_for_loop():
+    loop = asyncio.get_running_loop()
+    state = _loop_clients.get(loop)
+    if state is None:
+        state = _loop_clients[loop] = {
+            "clients": {},
+            "stack": AsyncExitStack(),
+            "lock": asyncio.Lock(),
+        }
+    return state
+
+
+async def get_async_client(service_name):
+    """
+    Returns an aiobotocore client for the service, created once per event loop.
+
+    Args:
+        service_name (str): The botocore service name, e.g. "bedrock-runtime"
+
+    Returns:
+        aiobotocore.client.AioBaseClient: A client shared by every request on
+            the running loop
+    """
+    state = _clients_for_loop()
+    client = state["clients"].get(service_name)
+    if client is None:
+        async with state["lock"]:
+            client = state["clients"].get(service_name)
+            if client is None:
+                client = await state["stack"].enter_async_context(
+                    get_aio_session().create_client(service_name, config=aio_config)
+                )
+                state["clients"][service_name] = client
+    return client
+
+
+async def get_async_opensearch_client():
+    """
+    Returns an AsyncOpenSearch client for the configured endpoint, created
+    once per event loop. Authentication follows clients.get_opensearch_client.
+    """
+    state = _clients_for_loop()
+    client = state["clients"].get("opensearch")
+    if client is None:
+        use_ssl = os.getenv("OPENSEARCH_USE_SSL", "true").lower() == "true"
+
+        if os.getenv("OPENSEARCH_AUTH", "sigv4") == "none":
+            auth = None
+        else:
+            credentials = get_session().get_credentials()
+            auth = AWSV4SignerAsyncAuth(credentials, os.getenv("AWS_REGION"), "aoss")
+
+        client = AsyncOpenSearch(
+            hosts=[
+                {
+                    "host": os.getenv("OPENSEARCH_ENDPOINT"),
+                    "port": int(os.getenv("OPENSEARCH_PORT", "443")),
+                }
+            ],
+            http_auth=auth,
+            use_ssl=use_ssl,
+            verify_certs=use_ssl,
+            connection_class=AsyncHttpConnection,
+            maxsize=MAX_POOL_CONNECTIONS,
+        )
+        state["clients"]["opensearch"] = client
+        state["stack"].push_async_callback(client.close)
+    return client
+
+
+async def close_clients():
+    """Closes the clients of the running loop, e.g. on ASGI shutdown."""
+    state = _loop_clients.pop(asyncio.get_running_loop(), None)
+    if state is not None:
+        await state["stack"].aclose()
+
+
+async def generate_text_embedding(message):
+    """
+    Embeds a query, serving repeated questions from the embedding cache.
+
+    Args:
+        message (str): The query text to embed
+
+    Returns:
+        list: The embedding as a list of floats
+    """
+    model_id = os.getenv("EMBEDDING_MODEL_ID")
+    key = cache_key(message, model_id)
+
+    # A shared cache backend does network IO, keep it off the loop
+    if embedding_cache.backend is not None:
+        cached = await asyncio.to_thread(embedding_cache.get, key)
+    else:
+        cached = embedding_cache.get(key)
+    if cached is not None:
+        return cached.tolist()
+
+    bedrock = await get_async_client("bedrock-runtime")
+    response = await bedrock.invoke_model(
+        modelId=model_id, body=json.dumps({"inputText": message})
+    )
+    embedding = json.loads(await response["body"].read())["embedding"]
+
+    if embedding_cache.backend is not None:
+        vector = await asyncio.to_thread(embedding_cache.put, key, embedding)
+    else:
+        vector = embedding_cache.put(key, embedding)
+    return vector.tolist()
+
+
+async def get_index_version():
+    """Async counterpart of opensearch_query.get_index_version, sharing its cache."""
+    now = time.time()
+    if now - _index_version["checked_at"] > INDEX_VERSION_TTL:
+        osClient = await get_async_opensearch_client()
+        response = await osClient.count(index=os.getenv("OPENSEARCH_INDEX"))
+        _index_version["value"] = response["count"]
+        _index_version["checked_at"] = now
+    return _index_version["value"]
+
+
+async def timed_search(osClient, query, leg, params=None):
+    """Runs a single search request and logs how long the leg took."""
+    start = time.perf_counter()
+    results = await osClient.search(
+        index=os.getenv("OPENSEARCH_INDEX"), body=query, params=params
+    )
+    logger.info(
+        f"{leg} search took {(time.perf_counter() - start) * 1000:.1f} ms "
+        f"(server {results.get('took')} ms)"
+    )
+    return results
+
+
+async def search_hybrid(osClient, prompt, embedding, size=10):
+    """
+    Fetches `size` candidates per leg and fuses them, as
+    opensearch_query.search_hybrid does.
+
+    Args:
+        osClient (AsyncOpenSearch): The OpenSearch client
+        prompt (str): The user query used for the lexical leg
+        embedding (asyncio.Task): Task resolving to the query vector. The
+            lexical leg runs while it is pending.
+        size (int): Number of hits to fetch from each leg
+
+    Returns:
+        tuple: The fused results and the results to judge flatness on
+    """
+    if _pipeline_available["value"]:
+        hybrid_query = {
+            "query": {
+                "hybrid": {
+                    "queries": [
+                        {"match": {"passage": prompt}},
+                        {"knn": {"embedding": {"vector": await embedding, "k": size}}},
+                    ]
+                }
+            },
+            "size": size,
+            "_source": {"exclude": ["embedding"]},
+        }
+        try:
+            hybrid_results = await timed_search(
+                osClient,
+                hybrid_query,
+                "Hybrid pipeline",
+                params={"search_pipeline": SEARCH_PIPELINE},
+            )
+            return hybrid_results, hybrid_results
+        except (RequestError, NotFoundError) as e:
+            logger.warning(
+                f"Search pipeline {SEARCH_PIPELINE} unavailable, "
+                f"falling back to client-side fusion: {e}"
+            )
+            _pipeline_available["value"] = False
+
+    lexical_query = {
+        "query": {"match": {"passage": prompt}},
+        "size": size,
+        "_source": {"exclude": ["embedding"]},
+    }
+
+    async def semantic_leg():
+        semantic_query = {
+            "query": {"knn": {"embedding": {"vector": await embedding, "k": size}}},
+            "size": size,
+            "_source": {"exclude": ["embedding"]},
+        }
+        return await timed_search(osClient, semantic_query, "Semantic")
+
+    lexical_results, semantic_results = await asyncio.gather(
+        timed_search(osClient, lexical_query, "Lexical"), semantic_leg()
+    )
+
+    hybrid_results = hybrid_search(
+        size * 2,
+        lexical_results,
+        semantic_results,
+        interpolation_weight=0.5,
+        normalizer="minmax",
+        use_rrf=False,
+    )
+    return hybrid_results, semantic_results
+
+
+async def get_documents(prompt, embedding, size=None, timings=None):
+    """
+    Retrieves the passages for a query with the same adaptive depth,
+    reranking and selection as opensearch_query.get_documents.
+
+    Args:
+        prompt (str): The user query used for the lexical leg
+        embedding (asyncio.Task): Task resolving to the query vector
+        size (int): Initial number of hits to fetch from each leg
+        timings (dict): Optional dict that stage durations in ms are added to
+
+    Returns:
+        list: The selected OpenSearch hits
+    """
+    if timings is None:
+        timings = {}
+    osClient = await get_async_opensearch_client()
+    size = size or RETRIEVAL_INITIAL_SIZE
+    fetched = 0
+
+    start = time.perf_counter()
+    while True:
+        hybrid_results, raw_results = await search_hybrid(
+            osClient, prompt, embedding, size
+        )
+        if size >= RETRIEVAL_MAX_SIZE or not is_flat(raw_results, fetched, size):
+            break
+        # Only the ranks fetched this round decide whether to widen again
+        fetched, size = size, min(size * 2, RETRIEVAL_MAX_SIZE)
+        logger.info(f"Flat score distribution, widening candidates to {size}")
+    timings["retrieval"] = (time.perf_counter() - start) * 1000
+
+    reranker = get_reranker()
+    if reranker is not None:
+        start = time.perf_counter()
+        # The reranker is synchronous and enforces its own latency budget
+        hybrid_results = await asyncio.to_thread(
+            rerank_results, prompt, hybrid_results, reranker
+        )
+        timings["rerank"] = (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    selected_docs = select_top_documents(hybrid_results)
+    timings["selection"] = (time.perf_counter() - start) * 1000
+
+    return selected_docs
+
+
+async def retrieve_documents(user_query, session=None, timings=None):
+    """
+    Async counterpart of chatbot_backend.retrieve_documents.
+
+    Returns:
+        tuple: The search query, a task for its embedding, a task for the
+            embedding of the user query itself and the passages
+    """
+    search_query = rewrite_query(user_query, session) if session else user_query
+
+    # Embed concurrently so the lexical search leg can start immediately
+    embedding = asyncio.ensure_future(generate_text_embedding(search_query))
+    query_embedding = embedding
+    if search_query != user_query:
+        query_embedding = asyncio.ensure_future(generate_text_embedding(user_query))
+
+    if session and session["last_documents"]:
+        selected_docs = reusable_documents(session, await query_embedding)
+        if selected_docs is not None:
+            logger.info("Follow-up on the same topic, reusing previous passages")
+            return search_query, embedding, query_embedding, selected_docs
+
+    selected_docs = await get_documents(search_query, embedding, timings=timings)
+    return search_query, embedding, query_embedding, selected_docs
+
+
+async def invoke_model(prompt, model_id, max_tokens=4096):
+    """
+    Calls Bedrock for a given modelid
+
+    Args:
+        prompt (str): The text prompt to send to the model
+        model_id (str): The model identifier
+        max_tokens (int): Maximum number of tokens to generate
+
+    Returns:
+        str: The text response from the model
+    """
+    bedrock = await get_async_client("bedrock-runtime")
+
+    try:
+        inference_config = {"maxTokens": max_tokens, "temperature": 1, "topP": 0.999}
+        messages = [{"role": "user", "content": [{"text": prompt}]}]
+
+        response = await bedrock.converse(
+            modelId=model_id,
+            messages=messages,
+            inferenceConfig=inference_config,
+        )
+
+        logger.info(f"Model usage: {response.get('usage')}")
+
+        return response["output"]["message"]["content"][0]["text"]
+
+    except Exception as e:
+        print(f"Error calling the model: {str(e)}")
+        return None
+
+
+async def presign_links(text, uuid_mapping, expiration=3600):
+    """
+    Presigns every S3 URI the answer links to concurrently and stores them
+    in the presigned URL cache, so process_text only does lookups.
+    """
+    s3_uris = set()
+    for image_uri, uuid in LINK_PATTERN.findall(text):
+        s3_uri = image_uri or uuid_mapping.get(uuid)
+        if s3_uri and not get_cached_presigned_url(s3_uri, expiration):
+            s3_uris.add(s3_uri)
+    if not s3_uris:
+        return
+
+    s3_client = await get_async_client("s3")
+
+    async def presign(s3_uri):
+        parsed_uri = urlparse(s3_uri)
+        try:
+            presigned_url = await s3_client.generate_presigned_url(
+                "get_object",
+                Params={"Bucket": parsed_uri.netloc, "Key": parsed_uri.path.lstrip("/")},
+                ExpiresIn=expiration,
+            )
+        except Exception as e:
+            print(f"Error: {str(e)}")
+            return
+        cache_presigned_url(s3_uri, presigned_url, expiration)
+
+    await asyncio.gather(*(presign(s3_uri) for s3_uri in s3_uris))
+
+
+async def handle_chat(body_data):
+    """
+    Answers one chat request.
+
+    Args:
+        body_data (dict): The request body, {"query": ..., "session_id": ...}
+
+    Returns:
+        tuple: The HTTP status code and the JSON-serializable response body
+    """
+    try:
+        user_query = body_data["query"]
+        session_id = body_data.get("session_id")
+
+        timings = {}
+
+        session = None
+        if session_id:
+            session = await asyncio.to_thread(load_session, session_id)
+        history = format_history(session) if session else ""
+
+        _, embedding, query_embedding, selected_docs = await retrieve_documents(
+            user_query, session, timings
+        )
+
+        # Answers to follow-ups depend on the conversation, so only cache fresh questions
+        use_answer_cache = ANSWER_CACHE_ENABLED and not history
+
+        cached = None
+        if use_answer_cache:
+            doc_ids = [doc["_id"] for doc in selected_docs]
+            index_version = await get_index_version()
+            cached = answer_cache.lookup(await embedding, doc_ids, index_version)
+
+        if cached:
+            # Raw answers are cached so presigned links are regenerated below
+            logger.info("Serving answer from the semantic answer cache")
+            model_response = cached["answer"]
+            source_mapping = cached["source_mapping"]
+        else:
+            start = time.perf_counter()
+            prompt, source_mapping, _ = build_prompt(
+                user_query, selected_docs, history
+            )
+            timings["prompt"] = (time.perf_counter() - start) * 1000
+
+            start = time.perf_counter()
+            model_response = await invoke_model(prompt, os.getenv("CHAT_MODEL_ID"))
+            timings["generation"] = (time.perf_counter() - start) * 1000
+
+            if use_answer_cache and model_response:
+                answer_cache.put(
+                    await embedding,
+                    doc_ids,
+                    model_response,
+                    source_mapping,
+                    index_version,
+                )
+
+        logger.info(f"Embedding cache: {embedding_cache.stats()}")
+
+        if session:
+            record_turn(
+                session,
+                user_query,
+                model_response,
+                await query_embedding,
+                selected_docs,
+            )
+            await asyncio.to_thread(save_session, session_id, session)
+
+        start = time.perf_counter()
+        await presign_links(model_response, source_mapping)
+        parsed_chat_respose = process_text(model_response, source_mapping)
+        timings["postprocess"] = (time.perf_counter() - start) * 1000
+
+        logger.info(
+            "Stage timings (ms): "
+            + ", ".join(f"{stage}={ms:.1f}" for stage, ms in timings.items())
+        )
+
+        return 200, parsed_chat_respose
+
+    except Exception as e:
+        logger.error(f"Error in handle_chat: {e}")
+        return 500, "Error processing message"
+
+
+# Lambda runs one request at a time per container; keeping a single loop
+# alive across invocations keeps its clients and connection pools warm
+_loop = asyncio.new_event_loop()
+
+
+def lambda_handler(event, context):
+    try:
+        body_data = json.loads(event["body"])
+    except Exception as e:
+        logger.error(f"Error in lambda_handler: {e}")
+        return {"statusCode": 500, "body": json.dumps("Error processing message")}
+
+    status_code, body = _loop.run_until_complete(handle_chat(body_data))
+    return {"statusCode": status_code, "body": json.dumps(body)}
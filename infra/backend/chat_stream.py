@@ -0,0 +1,96 @@
+"""
+WebSocket entry point that streams chat answers to the client as Claude
+generates them, instead of returning one JSON body at the end.
+
+Messages sent to the client are JSON objects:
+    {"type": "delta", "text": "..."}   a piece of the processed answer
+    {"type": "done"}                   the answer is complete
+    {"type": "error", "text": "..."}   the request failed
+"""
+
+import json
+import logging
+import os
+
+# The chat path (boto3, OpenSearch, NumPy) is imported on the first message,
+# so $connect and $disconnect on a cold container return without loading it
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Small deltas are batched so each post_to_connection carries a few tokens
+STREAM_MIN_CHARS = int(os.getenv("STREAM_MIN_CHARS", "32"))
+
+
+def send_message(event, message):
+    """Posts a JSON message back to the WebSocket connection of an event."""
+    from clients import get_client
+
+    request_context = event["requestContext"]
+    endpoint_url = f"https://{request_context['domainName']}/{request_context['stage']}"
+    get_client("apigatewaymanagementapi", endpoint_url).post_to_connection(
+        ConnectionId=request_context["connectionId"],
+        Data=json.dumps(message).encode("utf-8"),
+    )
+
+
+def stream_answer(event, user_query, session_id=None):
+    """Retrieves context for a query and streams the answer to the client."""
+    from chatbot_backend import (
+        StreamingTextProcessor,
+        build_prompt,
+        invoke_model_stream,
+        retrieve_documents,
+    )
+    from conversation import format_history, load_session, record_turn, save_session
+
+    session = load_session(session_id) if session_id else None
+    history = format_history(session) if session else ""
+
+    _, _, query_embedding, selected_docs = retrieve_documents(user_query, session)
+
+    prompt, source_mapping, _ = build_prompt(user_query, selected_docs, history)
+
+    processor = StreamingTextProcessor(source_mapping)
+    answer = ""
+    pending = ""
+    for delta in invoke_model_stream(prompt, os.getenv("CHAT_MODEL_ID")):
+        answer += delta
+        pending += processor.feed(delta)
+        if len(pending) >= STREAM_MIN_CHARS:
+            send_message(event, {"type": "delta", "text": pending})
+            pending = ""
+
+    pending += processor.flush()
+    if pending:
+        send_message(event, {"type": "delta", "text": pending})
+    send_message(event, {"type": "done"})
+
+    if session:
+        record_turn(
+            session,
+            user_query,
+            answer,
+            query_embedding.result(),
+            selected_docs,
+        )
+        save_session(session_id, session)
+
+
+def lambda_handler(event, context):
+    route_key = event["requestContext"]["routeKey"]
+    if route_key in ("$connect", "$disconnect"):
+        return {"statusCode": 200}
+
+    try:
+        body_data = json.loads(event["body"])
+        stream_answer(event, body_data["query"], body_data.get("session_id"))
+        return {"statusCode": 200}
+
+    except Exception as e:
+        logger.error(f"Error in streaming lambda_handler: {e}")
+        try:
+            send_message(event, {"type": "error", "text": "Error processing message"})
+        except Exception as send_error:
+            logger.error(f"Could not report error to client: {send_error}")
+        return {"statusCode": 500}
@@ -1,11 +1,24 @@
+import hashlib
 import json
 import logging
 from botocore.exceptions import ClientError
-from search_utils import generate_text_embedding
-from opensearch_query import get_documents, generate_short_uuid
-import boto3
+from search_utils import estimate_tokens, generate_text_embedding
+from prompt_builder import build_context
+from embedding_cache import embedding_cache
+from opensearch_query import get_documents, get_index_version
+from answer_cache import ANSWER_CACHE_ENABLED, answer_cache
+from conversation import (
+    format_history,
+    load_session,
+    record_turn,
+    reusable_documents,
+    rewrite_query,
+    save_session,
+)
+from clients import get_client, get_executor
 import os
 import re
+import time
 from urllib.parse import urlparse
 from botocore.exceptions import NoCredentialsError
 
@@ -13,7 +26,10 @@ from botocore.exceptions import NoCredentialsError
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-s3_client = boto3.client("s3")
+# Presigned URLs are reused for this share of their lifetime before re-signing
+PRESIGNED_URL_REUSE_FRACTION = 0.75
+PRESIGNED_URL_CACHE_SIZE = 4096
+_presigned_urls = {}
 
 
 def invoke_model(prompt, model_id, max_tokens=4096):
@@ -28,7 +44,7 @@ def invoke_model(prompt, model_id, max_tokens=4096):
     Returns:
         str: The text response from the model
     """
-    bedrock = boto3.client("bedrock-runtime")
+    bedrock = get_client("bedrock-runtime")
 
     try:
         inference_config = {"maxTokens": max_tokens, "temperature": 1, "topP": 0.999}
@@ -40,6 +56,8 @@ def invoke_model(prompt, model_id, max_tokens=4096):
             inferenceConfig=inference_config,
         )
 
+        logger.info(f"Model usage: {response.get('usage')}")
+
         return response["output"]["message"]["content"][0]["text"]
 
     except Exception as e:
@@ -47,10 +65,57 @@ def invoke_model(prompt, model_id, max_tokens=4096):
         return None
 
 
+def invoke_model_stream(prompt, model_id, max_tokens=4096):
+    """
+    Calls Bedrock for a given modelid and yields the answer as it is generated
+
+    Args:
+        prompt (str): The text prompt to send to the model
+        model_id (str): The model identifier
+        max_tokens (int): Maximum number of tokens to generate
+
+    Yields:
+        str: Text deltas in the order the model produces them
+    """
+    bedrock = get_client("bedrock-runtime")
+
+    inference_config = {"maxTokens": max_tokens, "temperature": 1, "topP": 0.999}
+    messages = [{"role": "user", "content": [{"text": prompt}]}]
+
+    response = bedrock.converse_stream(
+        modelId=model_id,
+        messages=messages,
+        inferenceConfig=inference_config,
+    )
+
+    for event in response["stream"]:
+        if "contentBlockDelta" in event:
+            yield event["contentBlockDelta"]["delta"].get("text", "")
+
+
+def get_cached_presigned_url(s3_uri, expiration=3600):
+    """Returns a cached presigned URL that is still in its reuse window, or None."""
+    cached = _presigned_urls.get((s3_uri, expiration))
+    if cached and time.time() - cached[1] < expiration * PRESIGNED_URL_REUSE_FRACTION:
+        return cached[0]
+    return None
+
+
+def cache_presigned_url(s3_uri, presigned_url, expiration=3600):
+    """Remembers a freshly signed URL for later requests."""
+    if len(_presigned_urls) >= PRESIGNED_URL_CACHE_SIZE:
+        _presigned_urls.clear()
+    _presigned_urls[(s3_uri, expiration)] = (presigned_url, time.time())
+
+
 def s3_uri_to_presigned_url(s3_uri, expiration=3600):
     """
     Convert an S3 URI to a presigned URL
 
+    URLs are cached per URI and reused for the first part of their lifetime,
+    so a link handed out from the cache is still valid for most of the
+    expiration window.
+
     Args:
         s3_uri (str): S3 URI in format 's3://bucket-name/path/to/file'
         expiration (int): URL expiration time in seconds (default: 1 hour)
@@ -58,14 +123,18 @@ def s3_uri_to_presigned_url(s3_uri, expiration=3600):
     Returns:
         str: Presigned URL or None if there's an error
     """
+    cached = get_cached_presigned_url(s3_uri, expiration)
+    if cached:
+        return cached
+
     try:
         # Parse the S3 URI
         parsed_uri = urlparse(s3_uri)
         bucket_name = parsed_uri.netloc
         object_key = parsed_uri.path.lstrip("/")
 
-        # Create S3 client
-        s3_client = boto3.client("s3")
+        # Reuse the container's S3 client
+        s3_client = get_client("s3")
 
         # Generate presigned URL
         presigned_url = s3_client.generate_presigned_url(
@@ -73,6 +142,8 @@ def s3_uri_to_presigned_url(s3_uri, expiration=3600):
             Params={"Bucket": bucket_name, "Key": object_key},
             ExpiresIn=expiration,
         )
+
+        cache_presigned_url(s3_uri, presigned_url, expiration)
         return presigned_url
 
     except NoCredentialsError:
@@ -90,73 +161,233 @@ def get_filename_from_s3_uri(s3_uri):
     return os.path.basename(parsed_uri.path)
 
 
-def process_text(text, uuid_mapping):
-    """Replaces s3 uris and uuids with presign urls to sources."""
+# Matches image markdown pointing at S3 (group 1) or a <uuid> citation (group 2)
+LINK_PATTERN = re.compile(r"!\[\]\((s3://[^\)]+)\)|<([a-f0-9]{8})>")
 
-    def replace_image_uri(match):
-        s3_uri = match.group(0)[4:-1]
-        if s3_uri:
-            presigned_url = s3_uri_to_presigned_url(s3_uri)
-            file_name = get_filename_from_s3_uri(s3_uri)
-            return f"![{file_name}]({presigned_url})"
-        return "![]()"
 
-    # First replace all S3 URIs in image markdown
-    image_pattern = r"!\[\]\(s3://[^\)]+\)"
-    text = re.sub(image_pattern, replace_image_uri, text)
+def process_text(text, uuid_mapping):
+    """Replaces s3 uris and citation ids with presign urls to sources."""
+    # Each distinct URI is presigned once per response
+    links = {}
+
+    def get_link(s3_uri):
+        if s3_uri not in links:
+            links[s3_uri] = (
+                get_filename_from_s3_uri(s3_uri),
+                s3_uri_to_presigned_url(s3_uri),
+            )
+        return links[s3_uri]
 
-    # Then replace all UUIDs with their corresponding sources
-    uuid_pattern = r"<([a-f0-9]{8})>"
+    def replace_link(match):
+        image_uri, uuid = match.groups()
+        if image_uri:
+            file_name, presigned_url = get_link(image_uri)
+            return f"![{file_name}]({presigned_url})"
 
-    def replace_uuid(match):
-        uuid = match.group(1)
         s3_uri = uuid_mapping.get(uuid)
         if s3_uri:
-            presigned_url = s3_uri_to_presigned_url(s3_uri)
-            file_name = get_filename_from_s3_uri(s3_uri)
+            file_name, presigned_url = get_link(s3_uri)
             return f"[{file_name}]({presigned_url})"
         return "[]()"
 
-    text = re.sub(uuid_pattern, replace_uuid, text)
+    return LINK_PATTERN.sub(replace_link, text)
+
+
+class StreamingTextProcessor:
+    """
+    Applies process_text to a stream of model deltas.
+
+    Text is released as soon as it cannot be the start of an unfinished
+    <uuid> citation or ![](s3://...) image link; a possible partial match at
+    the end of the buffer is held back until the next delta completes it.
+    """
 
-    return text
+    IMAGE_PREFIX = "![](s3://"
+
+    def __init__(self, uuid_mapping):
+        self.uuid_mapping = uuid_mapping
+        self.buffer = ""
+
+    def _hold_from(self):
+        """Returns the index where a possibly incomplete link starts."""
+        citation_start = self.buffer.rfind("<")
+        if citation_start != -1 and re.fullmatch(
+            r"<[a-f0-9]{0,8}", self.buffer[citation_start:]
+        ):
+            return citation_start
+
+        image_start = self.buffer.rfind("!")
+        if image_start != -1:
+            tail = self.buffer[image_start:]
+            if self.IMAGE_PREFIX.startswith(tail) or (
+                tail.startswith(self.IMAGE_PREFIX) and ")" not in tail
+            ):
+                return image_start
+
+        return len(self.buffer)
+
+    def feed(self, delta):
+        """Adds a delta and returns any text that is now safe to send."""
+        self.buffer += delta
+        hold_from = self._hold_from()
+        ready, self.buffer = self.buffer[:hold_from], self.buffer[hold_from:]
+        return process_text(ready, self.uuid_mapping) if ready else ""
+
+    def flush(self):
+        """Returns whatever is left once the model has finished."""
+        ready, self.buffer = self.buffer, ""
+        return process_text(ready, self.uuid_mapping) if ready else ""
+
+
+def citation_id(source_url):
+    """Returns the short id a source is cited by, the same on every request."""
+    return hashlib.sha1(source_url.encode("utf-8")).hexdigest()[:8]
 
 
 def generate_source_mapping(documents):
-    """Generates a mapping from a generated uuid:source url for llm to read."""
-    source_mapping = {}
-    for item in documents:
-        if item.get("_source"):
-            print(f"Passage: {item['_source']['passage']}\nScore: {item['_score']}\n")
+    """Generates a mapping from a citation id:source url for llm to read."""
+    return {
+        citation_id(item["_source"]["source_url"]): item["_source"]["source_url"]
+        for item in documents
+        if item.get("_source")
+    }
 
-            source_id = generate_short_uuid()
-            source_mapping[source_id] = item["_source"]["source_url"]
 
-    return source_mapping
+def build_prompt(user_query, selected_docs, history=""):
+    """
+    Builds the chat prompt and the id:source mapping its citations use.
+    Every passage is labelled with its source's citation id, so passages from
+    the same source share one id. `history` is the formatted conversation so
+    far, if the request belongs to a session.
+
+    Returns:
+        tuple: The prompt, the source mapping and the prompt's estimated
+            input token count
+    """
+    cited_documents = [
+        (citation_id(doc["_source"]["source_url"]), doc)
+        for doc in selected_docs
+        if doc.get("_source")
+    ]
+
+    documents, used_ids, _ = build_context(cited_documents)
+    source_mapping = generate_source_mapping(selected_docs)
+    source_mapping = {source_id: source_mapping[source_id] for source_id in used_ids}
+
+    prompt = (
+        history
+        + "User:"
+        + user_query
+        + os.getenv("CHAT_PROMPT").format(
+            documents=documents, citations=", ".join(used_ids)
+        )
+    )
+
+    input_tokens = estimate_tokens(prompt)
+    logger.info(f"Prompt built with {len(used_ids)} sources, ~{input_tokens} tokens")
+
+    return prompt, source_mapping, input_tokens
+
+
+def retrieve_documents(user_query, session=None, timings=None):
+    """
+    Retrieves the passages for a query, using conversation state if given.
+
+    Follow-ups are rewritten into a standalone search query, and when the
+    question stays on the previous turn's topic its passages are reused
+    instead of retrieving again.
+
+    Returns:
+        tuple: The search query, a future for its embedding, a future for the
+            embedding of the user query itself and the passages
+    """
+    search_query = rewrite_query(user_query, session) if session else user_query
+
+    # Embed in the background so the lexical search leg can start immediately
+    embedding = get_executor().submit(generate_text_embedding, search_query)
+    query_embedding = embedding
+    if search_query != user_query:
+        query_embedding = get_executor().submit(generate_text_embedding, user_query)
+
+    if session and session["last_documents"]:
+        selected_docs = reusable_documents(session, query_embedding.result())
+        if selected_docs is not None:
+            logger.info("Follow-up on the same topic, reusing previous passages")
+            return search_query, embedding, query_embedding, selected_docs
+
+    selected_docs = get_documents(search_query, embedding, timings=timings)
+    return search_query, embedding, query_embedding, selected_docs
 
 
 def lambda_handler(event, context):
     try:
         body_data = json.loads(event["body"])
         user_query = body_data["query"]
+        session_id = body_data.get("session_id")
 
-        embedding = generate_text_embedding(user_query)
-
-        selected_docs = get_documents(user_query, embedding)
+        timings = {}
 
-        source_mapping = generate_source_mapping(selected_docs)
+        session = load_session(session_id) if session_id else None
+        history = format_history(session) if session else ""
 
-        prompt = (
-            "User:"
-            + user_query
-            + os.getenv("CHAT_PROMPT").format(
-                documents=selected_docs, citations=str(source_mapping)
-            )
+        _, embedding, query_embedding, selected_docs = retrieve_documents(
+            user_query, session, timings
         )
 
-        model_response = invoke_model(prompt, os.getenv("CHAT_MODEL_ID"))
+        # Answers to follow-ups depend on the conversation, so only cache fresh questions
+        use_answer_cache = ANSWER_CACHE_ENABLED and not history
+
+        cached = None
+        if use_answer_cache:
+            doc_ids = [doc["_id"] for doc in selected_docs]
+            index_version = get_index_version()
+            cached = answer_cache.lookup(embedding.result(), doc_ids, index_version)
+
+        if cached:
+            # Raw answers are cached so presigned links are regenerated below
+            logger.info("Serving answer from the semantic answer cache")
+            model_response = cached["answer"]
+            source_mapping = cached["source_mapping"]
+        else:
+            start = time.perf_counter()
+            prompt, source_mapping, _ = build_prompt(
+                user_query, selected_docs, history
+            )
+            timings["prompt"] = (time.perf_counter() - start) * 1000
+
+            start = time.perf_counter()
+            model_response = invoke_model(prompt, os.getenv("CHAT_MODEL_ID"))
+            timings["generation"] = (time.perf_counter() - start) * 1000
+
+            if use_answer_cache and model_response:
+                answer_cache.put(
+                    embedding.result(),
+                    doc_ids,
+                    model_response,
+                    source_mapping,
+                    index_version,
+                )
+
+        logger.info(f"Embedding cache: {embedding_cache.stats()}")
+
+        if session:
+            record_turn(
+                session,
+                user_query,
+                model_response,
+                query_embedding.result(),
+                selected_docs,
+            )
+            save_session(session_id, session)
 
+        start = time.perf_counter()
         parsed_chat_respose = process_text(model_response, source_mapping)
+        timings["postprocess"] = (time.perf_counter() - start) * 1000
+
+        logger.info(
+            "Stage timings (ms): "
+            + ", ".join(f"{stage}={ms:.1f}" for stage, ms in timings.items())
+        )
 
         return {"statusCode": 200, "body": json.dumps(parsed_chat_respose)}
 
@@ -0,0 +1,123 @@
+"""
+Per-container registry of AWS and OpenSearch clients.
+
+Lambda keeps module state alive between warm invocations, so clients built
+here are created once per container and reused, keeping their HTTP
+connection pools (and TLS sessions) open across requests.
+"""
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from botocore.config import Config
+
+MAX_POOL_CONNECTIONS = int(os.getenv("MAX_POOL_CONNECTIONS", "10"))
+
+boto_config = Config(
+    max_pool_connections=MAX_POOL_CONNECTIONS,
+    tcp_keepalive=True,
+    retries={"max_attempts": 3, "mode": "standard"},
+)
+
+_lock = threading.RLock()
+_session = None
+_clients = {}
+_executor = None
+
+
+def get_session():
+    """Returns the boto3 session shared by every client in this container."""
+    global _session
+    if _session is None:
+        with _lock:
+            if _session is None:
+                _session = boto3.Session()
+    return _session
+
+
+def get_executor():
+    """Returns the thread pool used to overlap network calls within a request."""
+    global _executor
+    if _executor is None:
+        with _lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=MAX_POOL_CONNECTIONS)
+    return _executor
+
+
+def get_client(service_name, endpoint_url=None):
+    """
+    Returns a cached boto3 client for the given service.
+
+    Args:
+        service_name (str): The boto3 service name, e.g. "s3" or "bedrock-runtime"
+        endpoint_url (str): Optional endpoint override, e.g. for the API Gateway
+            management API of a WebSocket stage
+
+    Returns:
+        botocore.client.BaseClient: A client shared across invocations
+    """
+    key = (service_name, endpoint_url)
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                client = get_session().client(
+                    service_name, endpoint_url=endpoint_url, config=boto_config
+                )
+                _clients[key] = client
+    return client
+
+
+def get_opensearch_client():
+    """
+    Returns a cached OpenSearch client for the configured endpoint.
+
+    Requests are signed with AWSV4SignerAuth, which reads frozen credentials
+    from the session's credential provider on every request, so temporary
+    credentials are only refreshed when they are about to expire.
+
+    Setting OPENSEARCH_AUTH=none (with OPENSEARCH_PORT and OPENSEARCH_USE_SSL)
+    points the client at an unsigned local OpenSearch container instead.
+    """
+    client = _clients.get("opensearch")
+    if client is None:
+        with _lock:
+            client = _clients.get("opensearch")
+            if client is None:
+                # Imported here rather than at module load: on a cold start
+                # this runs while the query embedding request is in flight
+                from opensearchpy import (
+                    AWSV4SignerAuth,
+                    OpenSearch,
+                    RequestsHttpConnection,
+                )
+
+                use_ssl = os.getenv("OPENSEARCH_USE_SSL", "true").lower() == "true"
+
+                if os.getenv("OPENSEARCH_AUTH", "sigv4") == "none":
+                    auth = None
+                else:
+                    credentials = get_session().get_credentials()
+                    auth = AWSV4SignerAuth(
+                        credentials, os.getenv("AWS_REGION"), "aoss"
+                    )
+
+                client = OpenSearch(
+                    hosts=[
+                        {
+                            "host": os.getenv("OPENSEARCH_ENDPOINT"),
+                            "port": int(os.getenv("OPENSEARCH_PORT", "443")),
+                        }
+                    ],
+                    http_auth=auth,
+                    use_ssl=use_ssl,
+                    verify_certs=use_ssl,
+                    connection_class=RequestsHttpConnection,
+                    pool_maxsize=MAX_POOL_CONNECTIONS,
+                )
+                _clients["opensearch"] = client
+    return client
@@ -0,0 +1,216 @@
+"""
+Server-side conversation memory for multi-turn chat.
+
+Each session keeps its last few turns verbatim, folds older turns into a
+short summary, and remembers the passages retrieved for the previous turn so
+a follow-up on the same topic can skip retrieval.
+"""
+
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from clients import get_client
+
+CONVERSATION_TTL = int(os.getenv("CONVERSATION_TTL", "3600"))
+CONVERSATION_MAX_TURNS = int(os.getenv("CONVERSATION_MAX_TURNS", "4"))
+CONVERSATION_REUSE_SIMILARITY = float(
+    os.getenv("CONVERSATION_REUSE_SIMILARITY", "0.85")
+)
+SUMMARY_MAX_CHARS = 1000
+# Longest gist of an answer kept in the summary of earlier turns
+SUMMARY_ANSWER_CHARS = 200
+ANSWER_MAX_CHARS = 600
+# Length of the previous question prefixed to a follow-up for retrieval
+PREVIOUS_QUERY_MAX_CHARS = 200
+
+# Words that usually point back at an earlier turn
+FOLLOW_UP_PATTERN = re.compile(
+    r"\b(it|its|that|this|these|those|they|them|their|there|also|else|"
+    r"same|what about|how about)\b",
+    re.IGNORECASE,
+)
+
+# Citation ids like <1a2b3c4d> the model puts after the points it cites
+CITATION_PATTERN = re.compile(r"\s*<[^<>\s]{1,40}>")
+SENTENCE_END_PATTERN = re.compile(r"(?<=[.!?])\s")
+
+
+class InMemoryConversationStore:
+    """Sessions kept in this container only, evicted by age and count."""
+
+    def __init__(self, ttl, max_sessions=1000):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id):
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is None or entry[1] < time.time():
+                self._sessions.pop(session_id, None)
+                return None
+            self._sessions.move_to_end(session_id)
+            return entry[0]
+
+    def put(self, session_id, state):
+        with self._lock:
+            self._sessions[session_id] = (state, time.time() + self.ttl)
+            self._sessions.move_to_end(session_id)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+
+
+class DynamoDBConversationStore:
+    """Sessions shared by every container through a DynamoDB table."""
+
+    def __init__(self, table_name, ttl):
+        self.table_name = table_name
+        self.ttl = ttl
+
+    def get(self, session_id):
+        response = get_client("dynamodb").get_item(
+            TableName=self.table_name, Key={"session_id": {"S": session_id}}
+        )
+        item = response.get("Item")
+        if not item or int(item["expires_at"]["N"]) < time.time():
+            return None
+        return json.loads(item["state"]["S"])
+
+    def put(self, session_id, state):
+        get_client("dynamodb").put_item(
+            TableName=self.table_name,
+            Item={
+                "session_id": {"S": session_id},
+                "state": {"S": json.dumps(state)},
+                "expires_at": {"N": str(int(time.time() + self.ttl))},
+            },
+        )
+
+
+def build_store():
+    if os.getenv("CONVERSATION_TABLE"):
+        return DynamoDBConversationStore(
+            os.getenv("CONVERSATION_TABLE"), CONVERSATION_TTL
+        )
+    return InMemoryConversationStore(CONVERSATION_TTL)
+
+
+conversation_store = build_store()
+
+
+def load_session(session_id):
+    """Returns the stored state for a session, or a fresh one."""
+    return conversation_store.get(session_id) or {
+        "summary": "",
+        "turns": [],
+        "last_embedding": None,
+        "last_documents": [],
+    }
+
+
+def save_session(session_id, session):
+    conversation_store.put(session_id, session)
+
+
+def rewrite_query(user_query, session):
+    """
+    Makes a follow-up question standalone for retrieval by prefixing the
+    previous question when the new one is short or refers back to it.
+
+    Only the previous question as the user asked it is prefixed, cut to
+    PREVIOUS_QUERY_MAX_CHARS, so search queries stay bounded however long
+    the conversation runs.
+    """
+    if not session["turns"]:
+        return user_query
+    if len(user_query.split()) > 6 and not FOLLOW_UP_PATTERN.search(user_query):
+        return user_query
+    previous = session["turns"][-1]["query"][:PREVIOUS_QUERY_MAX_CHARS]
+    return f"{previous} {user_query}"
+
+
+def reusable_documents(session, embedding):
+    """
+    Returns the previous turn's passages when the new query embedding is
+    close enough to the previous one to be on the same topic.
+
+    Both embeddings are of the questions as the user asked them, since a
+    rewritten query contains the previous question and would look on topic.
+    """
+    if not session["last_documents"] or session["last_embedding"] is None:
+        return None
+    previous = np.asarray(session["last_embedding"], dtype=np.float32)
+    current = np.asarray(embedding, dtype=np.float32)
+    norms = np.linalg.norm(previous) * np.linalg.norm(current)
+    if not norms or float(previous @ current) / norms < CONVERSATION_REUSE_SIMILARITY:
+        return None
+    return session["last_documents"]
+
+
+def format_history(session):
+    """Formats the summary and recent turns for the chat prompt."""
+    if not session["turns"]:
+        return ""
+    lines = ["Conversation so far:"]
+    if session["summary"]:
+        lines.append("Summary of earlier turns:")
+        lines.extend(session["summary"].splitlines())
+    for turn in session["turns"]:
+        lines.append(f"User: {turn['query']}")
+        lines.append(f"Assistant: {turn['answer']}")
+    return "\n".join(lines) + "\n\n"
+
+
+def summarize_turn(turn):
+    """
+    Condenses a turn to its question and the first sentence of its answer,
+    without citations, for the summary of earlier turns.
+    """
+    answer = " ".join(CITATION_PATTERN.sub("", turn["answer"]).split())
+    gist = SENTENCE_END_PATTERN.split(answer, 1)[0][:SUMMARY_ANSWER_CHARS]
+    return f"Q: {turn['query']} A: {gist}".strip()
+
+
+def record_turn(session, user_query, answer, query_embedding, documents):
+    """
+    Adds a turn and folds turns beyond CONVERSATION_MAX_TURNS into the summary,
+    one summarize_turn line each. The oldest lines are dropped once the
+    summary is longer than SUMMARY_MAX_CHARS.
+
+    query_embedding is the embedding of user_query itself, not of the
+    rewritten search query, for reusable_documents to compare against.
+    """
+    session["turns"].append(
+        {
+            "query": user_query,
+            "answer": (answer or "")[:ANSWER_MAX_CHARS],
+        }
+    )
+    while len(session["turns"]) > CONVERSATION_MAX_TURNS:
+        oldest = session["turns"].pop(0)
+        lines = session["summary"].splitlines() + [summarize_turn(oldest)]
+        while len(lines) > 1 and (
+            sum(len(line) + 1 for line in lines) > SUMMARY_MAX_CHARS
+        ):
+            lines.pop(0)
+        session["summary"] = "\n".join(lines)[-SUMMARY_MAX_CHARS:]
+
+    session["last_embedding"] = list(query_embedding)
+    session["last_documents"] = [
+        {
+            "_id": doc["_id"],
+            "_score": doc["_score"],
+            "_source": {
+                "passage": doc["_source"]["passage"],
+                "source_url": doc["_source"]["source_url"],
+            },
+        }
+        for doc in documents
+    ]
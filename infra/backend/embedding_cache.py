@@ -0,0 +1,180 @@
+"""
+In-process LRU/TTL cache for query embeddings, with optional shared backends
+so warm containers can reuse each other's vectors.
+"""
+
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from clients import get_client
+
+logger = logging.getLogger()
+
+
+def normalize_query(text):
+    """Lowercases, collapses whitespace and strips trailing punctuation."""
+    text = re.sub(r"\s+", " ", text.strip().lower())
+    return text.rstrip("?!. ")
+
+
+def cache_key(text, model_id):
+    """Builds the cache key for a query under a given embedding model."""
+    raw = f"{model_id}\x00{normalize_query(text)}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class FileCacheBackend:
+    """Shared cache stored as one .npy file per key in a local directory."""
+
+    def __init__(self, directory, ttl):
+        self.directory = directory
+        self.ttl = ttl
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.npy")
+
+    def get(self, key):
+        try:
+            if os.path.getmtime(self._path(key)) + self.ttl < time.time():
+                return None
+            return np.load(self._path(key))
+        except (OSError, ValueError):
+            return None
+
+    def put(self, key, vector):
+        # Write to a temp file first so readers never see a partial vector
+        tmp_path = self._path(key) + f".{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, vector)
+        os.replace(tmp_path, self._path(key))
+
+
+class DynamoDBCacheBackend:
+    """Shared cache stored in a DynamoDB table keyed on "cache_key"."""
+
+    def __init__(self, table_name, ttl):
+        self.table_name = table_name
+        self.ttl = ttl
+
+    def get(self, key):
+        response = get_client("dynamodb").get_item(
+            TableName=self.table_name, Key={"cache_key": {"S": key}}
+        )
+        item = response.get("Item")
+        if not item or int(item["expires_at"]["N"]) < time.time():
+            return None
+        return np.frombuffer(item["vector"]["B"], dtype=np.float32)
+
+    def put(self, key, vector):
+        get_client("dynamodb").put_item(
+            TableName=self.table_name,
+            Item={
+                "cache_key": {"S": key},
+                "vector": {"B": vector.tobytes()},
+                "expires_at": {"N": str(int(time.time() + self.ttl))},
+            },
+        )
+
+
+class EmbeddingCache:
+    """
+    Bounded LRU cache of float32 query embeddings with TTL eviction.
+
+    :param max_entries: Maximum number of vectors kept in memory.
+    :param ttl: Seconds an entry stays valid.
+    :param backend: Optional shared backend consulted on local misses.
+    """
+
+    def __init__(self, max_entries=1024, ttl=3600, backend=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.backend = backend
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                vector, expires_at = entry
+                if expires_at > time.time():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return vector
+                del self._entries[key]
+
+        if self.backend is not None:
+            try:
+                vector = self.backend.get(key)
+            except Exception as e:
+                logger.warning(f"Shared embedding cache read failed: {e}")
+                vector = None
+            if vector is not None:
+                self._store(key, vector)
+                with self._lock:
+                    self.shared_hits += 1
+                return vector
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        self._store(key, vector)
+        if self.backend is not None:
+            try:
+                self.backend.put(key, vector)
+            except Exception as e:
+                logger.warning(f"Shared embedding cache write failed: {e}")
+        return vector
+
+    def _store(self, key, vector):
+        with self._lock:
+            self._entries[key] = (vector, time.time() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        """Returns hit and miss counters for this container."""
+        with self._lock:
+            lookups = self.hits + self.shared_hits + self.misses
+            return {
+                "hits": self.hits,
+                "shared_hits": self.shared_hits,
+                "misses": self.misses,
+                "size": len(self._entries),
+                "hit_rate": (
+                    (self.hits + self.shared_hits) / lookups if lookups else 0.0
+                ),
+            }
+
+
+def build_backend(ttl):
+    """Picks a shared backend from the environment, if one is configured."""
+    if os.getenv("EMBEDDING_CACHE_TABLE"):
+        return DynamoDBCacheBackend(os.getenv("EMBEDDING_CACHE_TABLE"), ttl)
+    if os.getenv("EMBEDDING_CACHE_DIR"):
+        return FileCacheBackend(os.getenv("EMBEDDING_CACHE_DIR"), ttl)
+    return None
+
+
+EMBEDDING_CACHE_TTL = int(os.getenv("EMBEDDING_CACHE_TTL", "3600"))
+
+embedding_cache = EmbeddingCache(
+    max_entries=int(os.getenv("EMBEDDING_CACHE_SIZE", "1024")),
+    ttl=EMBEDDING_CACHE_TTL,
+    backend=build_backend(EMBEDDING_CACHE_TTL),
+)
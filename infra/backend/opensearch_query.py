@@ -1,55 +1,188 @@
-import boto3
-from opensearchpy import OpenSearch, RequestsHttpConnection
-from requests_aws4auth import AWS4Auth
-from search_utils import hybrid_search
+from clients import get_executor, get_opensearch_client
+from concurrent.futures import Future
+from rerank import get_reranker, rerank_results
+from search_utils import RETRIEVAL_TOKEN_BUDGET, estimate_tokens, hybrid_search
+import logging
 import os
-import uuid
+import time
+
+logger = logging.getLogger()
+
+INDEX_VERSION_TTL = int(os.getenv("INDEX_VERSION_TTL", "60"))
+_index_version = {"value": None, "checked_at": 0.0}
+
+# "client" fuses the two legs in search_utils, "pipeline" lets OpenSearch fuse
+# a single hybrid query through a normalization search pipeline
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "client")
+SEARCH_PIPELINE = os.getenv("SEARCH_PIPELINE", "hybrid-search-pipeline")
+_pipeline_available = {"value": RETRIEVAL_MODE == "pipeline"}
+
+# Adaptive retrieval: start small, widen on flat scores, stop on a steep drop
+RETRIEVAL_INITIAL_SIZE = int(os.getenv("RETRIEVAL_INITIAL_SIZE", "10"))
+RETRIEVAL_MAX_SIZE = int(os.getenv("RETRIEVAL_MAX_SIZE", "40"))
+RETRIEVAL_FLATNESS = float(os.getenv("RETRIEVAL_FLATNESS", "0.05"))
+RETRIEVAL_SCORE_DROP = float(os.getenv("RETRIEVAL_SCORE_DROP", "0.3"))
+
 
 def initialize_opensearch():
-    region = os.getenv("AWS_REGION")
-    service = "aoss"
-    host = os.getenv("OPENSEARCH_ENDPOINT")
-
-    credentials = boto3.Session().get_credentials()
-    awsauth = AWS4Auth(
-        credentials.access_key,
-        credentials.secret_key,
-        region,
-        service,
-        session_token=credentials.token,
-    )
+    """Returns the OpenSearch client shared across warm invocations."""
+    return get_opensearch_client()
+
+
+def get_index_version():
+    """
+    Returns a token that changes when documents are added to or removed from
+    the index. The document count is re-read at most every INDEX_VERSION_TTL
+    seconds so callers can check it on every request.
+    """
+    now = time.time()
+    if now - _index_version["checked_at"] > INDEX_VERSION_TTL:
+        response = initialize_opensearch().count(index=os.getenv("OPENSEARCH_INDEX"))
+        _index_version["value"] = response["count"]
+        _index_version["checked_at"] = now
+    return _index_version["value"]
 
-    client = OpenSearch(
-        hosts=[{"host": host, "port": 443}],
-        http_auth=awsauth,
-        use_ssl=True,
-        verify_certs=True,
-        connection_class=RequestsHttpConnection,
-    )
 
-    return client
+def select_top_documents(
+    hybrid_results, token_budget=None, max_score_drop=None, max_docs=None
+):
+    """
+    Selects the passages to send to the LLM.
 
+    Documents are taken best first until the drop from the previous score
+    exceeds max_score_drop (relative to the top score), or the next passage
+    would overflow the token budget. The best document is always kept.
+
+    Args:
+        hybrid_results (dict): Fused results in OpenSearch response format
+        token_budget (int): Estimated tokens available for passages
+        max_score_drop (float): Largest relative score drop between neighbours
+        max_docs (int): Optional hard cap on the number of documents
+
+    Returns:
+        list: The selected OpenSearch hits, best first
+    """
+    if token_budget is None:
+        token_budget = RETRIEVAL_TOKEN_BUDGET
+    if max_score_drop is None:
+        max_score_drop = RETRIEVAL_SCORE_DROP
 
-def select_top_documents(hybrid_results, max_docs=5):
     documents = hybrid_results["hits"]["hits"]
     sorted_docs = sorted(documents, key=lambda x: x["_score"], reverse=True)
+    if not sorted_docs:
+        return []
+
+    top_score = sorted_docs[0]["_score"] or 1.0
+    selected_docs = [sorted_docs[0]]
+    used_tokens = estimate_tokens(sorted_docs[0]["_source"]["passage"])
 
-    if len(sorted_docs) <= max_docs:
-        return sorted_docs
+    for previous, doc in zip(sorted_docs, sorted_docs[1:]):
+        if max_docs is not None and len(selected_docs) >= max_docs:
+            break
+        if (previous["_score"] - doc["_score"]) / top_score > max_score_drop:
+            break
+        tokens = estimate_tokens(doc["_source"]["passage"])
+        if used_tokens + tokens > token_budget:
+            break
+        selected_docs.append(doc)
+        used_tokens += tokens
 
-    selected_docs = sorted_docs[:max_docs]
-    scores = [doc["_score"] for doc in selected_docs]
+    logger.info(f"Selected {len(selected_docs)} passages, ~{used_tokens} tokens")
+    return selected_docs
 
-    score_diffs = [scores[i] - scores[i + 1] for i in range(len(scores) - 1)]
-    if score_diffs:
-        max_drop_index = max(score_diffs.index(max(score_diffs)), 4)
-        return sorted_docs[: max_drop_index + 1]
-    else:
-        return selected_docs
 
+def is_flat(results, start, end):
+    """
+    Checks whether the raw scores from rank `start` to rank `end` fall by
+    less than RETRIEVAL_FLATNESS of the top score, which suggests better
+    candidates may sit deeper. The last hit before `start` is included, so
+    a drop into the newly fetched ranks counts. Raw scores are used since
+    min-max normalized ones always span 0 to 1.
+    """
+    hits = results["hits"]["hits"]
+    if len(hits) < end or not hits[0]["_score"]:
+        return False
+    scores = [hit["_score"] for hit in hits[max(start - 1, 0) : end]]
+    return (scores[0] - scores[-1]) / hits[0]["_score"] < RETRIEVAL_FLATNESS
 
-def get_documents(prompt, embedding, size=10):
-    osClient = initialize_opensearch()
+
+def timed_search(osClient, query, leg):
+    """Runs a single search request and logs how long the leg took."""
+    start = time.perf_counter()
+    results = osClient.search(index=os.getenv("OPENSEARCH_INDEX"), body=query)
+    logger.info(
+        f"{leg} search took {(time.perf_counter() - start) * 1000:.1f} ms "
+        f"(server {results.get('took')} ms)"
+    )
+    return results
+
+
+def search_pipeline(osClient, prompt, embedding, size=10):
+    """
+    Runs one hybrid query that the search pipeline normalizes and fuses
+    server-side. Returns None if the cluster cannot serve it, in which case
+    pipeline mode is switched off for the rest of the container's life.
+    """
+    hybrid_query = {
+        "query": {
+            "hybrid": {
+                "queries": [
+                    {"match": {"passage": prompt}},
+                    {"knn": {"embedding": {"vector": embedding, "k": size}}},
+                ]
+            }
+        },
+        "size": size,
+        "_source": {"exclude": ["embedding"]},
+    }
+
+    from opensearchpy.exceptions import NotFoundError, RequestError
+
+    start = time.perf_counter()
+    try:
+        results = osClient.search(
+            index=os.getenv("OPENSEARCH_INDEX"),
+            body=hybrid_query,
+            params={"search_pipeline": SEARCH_PIPELINE},
+        )
+    except (RequestError, NotFoundError) as e:
+        logger.warning(
+            f"Search pipeline {SEARCH_PIPELINE} unavailable, "
+            f"falling back to client-side fusion: {e}"
+        )
+        _pipeline_available["value"] = False
+        return None
+
+    logger.info(
+        f"Hybrid pipeline search took {(time.perf_counter() - start) * 1000:.1f} ms "
+        f"(server {results.get('took')} ms)"
+    )
+    return results
+
+
+def search_hybrid(osClient, prompt, embedding, size=10):
+    """
+    Fetches `size` candidates per leg and fuses them.
+
+    Args:
+        osClient (OpenSearch): The OpenSearch client
+        prompt (str): The user query used for the lexical leg
+        embedding (list | Future): The query vector, or a future resolving to it.
+            When a future is given the lexical leg starts immediately and the
+            semantic leg starts as soon as the embedding arrives.
+        size (int): Number of hits to fetch from each leg
+
+    Returns:
+        tuple: The fused results, the results to judge flatness on (the raw
+            semantic leg, or the fused results in pipeline mode) and the
+            resolved embedding
+    """
+    if _pipeline_available["value"]:
+        if isinstance(embedding, Future):
+            embedding = embedding.result()
+        hybrid_results = search_pipeline(osClient, prompt, embedding, size)
+        if hybrid_results is not None:
+            return hybrid_results, hybrid_results, embedding
 
     lexical_query = {
         "query": {"match": {"passage": prompt}},
@@ -57,21 +190,30 @@ def get_documents(prompt, embedding, size=10):
         "_source": {"exclude": ["embedding"]},
     }
 
+    # The lexical leg does not need the vector, so start it right away
+    lexical_future = get_executor().submit(
+        timed_search, osClient, lexical_query, "Lexical"
+    )
+
+    if isinstance(embedding, Future):
+        start = time.perf_counter()
+        embedding = embedding.result()
+        logger.info(
+            f"Waited {(time.perf_counter() - start) * 1000:.1f} ms for query embedding"
+        )
+
     semantic_query = {
         "query": {"knn": {"embedding": {"vector": embedding, "k": size}}},
         "size": size,
         "_source": {"exclude": ["embedding"]},
     }
 
-    lexical_results = osClient.search(
-        index=os.getenv("OPENSEARCH_INDEX"), body=lexical_query
-    )
-    semantic_results = osClient.search(
-        index=os.getenv("OPENSEARCH_INDEX"), body=semantic_query
-    )
+    # Run the semantic leg on this thread while the lexical leg finishes
+    semantic_results = timed_search(osClient, semantic_query, "Semantic")
+    lexical_results = lexical_future.result()
 
     hybrid_results = hybrid_search(
-        20,
+        size * 2,
         lexical_results,
         semantic_results,
         interpolation_weight=0.5,
@@ -79,12 +221,60 @@ def get_documents(prompt, embedding, size=10):
         use_rrf=False,
     )
 
+    return hybrid_results, semantic_results, embedding
+
+
+def get_documents(prompt, embedding, size=None, timings=None):
+    """
+    Retrieves the passages for a query with an adaptive candidate depth.
+
+    A small candidate set is fetched first and only widened (doubling up to
+    RETRIEVAL_MAX_SIZE) while the scores of the ranks fetched last are flat.
+    The passages kept are then bounded by score drop and token budget rather
+    than a fixed count.
+
+    With RETRIEVAL_MODE=pipeline each round is a single hybrid query fused by
+    the cluster, falling back to the two legs if that fails.
+
+    When RERANKER is set, the top fused candidates are reranked within a
+    latency budget before selection.
+
+    Args:
+        prompt (str): The user query used for the lexical leg
+        embedding (list | Future): The query vector, or a future resolving to it
+        size (int): Initial number of hits to fetch from each leg
+        timings (dict): Optional dict that stage durations in ms are added to
+
+    Returns:
+        list: The selected OpenSearch hits
+    """
+    if timings is None:
+        timings = {}
+    osClient = initialize_opensearch()
+    size = size or RETRIEVAL_INITIAL_SIZE
+    fetched = 0
+
+    start = time.perf_counter()
+
+    while True:
+        hybrid_results, raw_results, embedding = search_hybrid(
+            osClient, prompt, embedding, size
+        )
+        if size >= RETRIEVAL_MAX_SIZE or not is_flat(raw_results, fetched, size):
+            break
+        # Only the ranks fetched this round decide whether to widen again
+        fetched, size = size, min(size * 2, RETRIEVAL_MAX_SIZE)
+        logger.info(f"Flat score distribution, widening candidates to {size}")
+    timings["retrieval"] = (time.perf_counter() - start) * 1000
+
+    reranker = get_reranker()
+    if reranker is not None:
+        start = time.perf_counter()
+        hybrid_results = rerank_results(prompt, hybrid_results, reranker)
+        timings["rerank"] = (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
     selected_docs = select_top_documents(hybrid_results)
+    timings["selection"] = (time.perf_counter() - start) * 1000
 
     return selected_docs
-
-def generate_short_uuid():
-    # Generate a full UUID
-    full_uuid = uuid.uuid4()
-    # Convert it to a string and take the first 8 characters
-    return str(full_uuid)[:8]
\ No newline at end of file
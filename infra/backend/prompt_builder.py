@@ -0,0 +1,95 @@
+"""
+Builds the document context sent to the chat model as compact
+"<uuid>: passage" blocks, trimmed to a token budget.
+"""
+
+from search_utils import RETRIEVAL_TOKEN_BUDGET, estimate_tokens
+
+# Overlapping chunks share exactly the configured ingest overlap; shorter
+# matches are treated as coincidence
+MIN_OVERLAP = 50
+MAX_OVERLAP = 2000
+
+
+def overlap_length(left, right):
+    """
+    Returns the length of the longest suffix of `left` that is also a prefix
+    of `right`, or 0 if it is shorter than MIN_OVERLAP.
+    """
+    if len(left) < MIN_OVERLAP or len(right) < MIN_OVERLAP:
+        return 0
+
+    probe = right[:MIN_OVERLAP]
+    start = max(0, len(left) - min(len(right), MAX_OVERLAP))
+    position = left.find(probe, start)
+    while position != -1:
+        # The earliest match that holds all the way to the end is the longest
+        if right.startswith(left[position:]):
+            return len(left) - position
+        position = left.find(probe, position + 1)
+    return 0
+
+
+def strip_overlap(passage, emitted):
+    """
+    Removes text that `passage` shares with passages already in the prompt
+    from the same source, so overlapping chunks are only sent once.
+    """
+    for previous in emitted:
+        # previous chunk ... | shared | ... this chunk
+        shared = overlap_length(previous, passage)
+        if shared:
+            passage = passage[shared:]
+        # this chunk ... | shared | ... previous chunk
+        shared = overlap_length(passage, previous)
+        if shared:
+            passage = passage[:-shared]
+    return passage.strip()
+
+
+def build_context(cited_documents, token_budget=None):
+    """
+    Formats passages as "<uuid>: passage" blocks.
+
+    Args:
+        cited_documents (list): (citation id, OpenSearch hit) pairs, best first
+        token_budget (int): Estimated tokens the passages may use in total,
+            by default the RETRIEVAL_TOKEN_BUDGET the passages were selected to
+
+    Returns:
+        tuple: The context text, the citation ids it uses and the estimated
+            tokens of its passages
+    """
+    if token_budget is None:
+        token_budget = RETRIEVAL_TOKEN_BUDGET
+
+    blocks = []
+    used_ids = []
+    used_tokens = 0
+    emitted = {}
+
+    for citation_id, doc in cited_documents:
+        source = doc["_source"]
+        passage = source["passage"]
+        passage = strip_overlap(passage, emitted.get(source["source_url"], []))
+        if not passage:
+            continue
+
+        # Only passage text counts against the budget, as in document
+        # selection, so every passage selected within it fits here as well
+        tokens = estimate_tokens(passage)
+        if used_tokens + tokens > token_budget:
+            if blocks:
+                break
+            # Always send something, cut down to the budget
+            passage = passage[: token_budget * 4]
+            tokens = estimate_tokens(passage)
+        block = f"<{citation_id}>: {passage}"
+
+        blocks.append(block)
+        emitted.setdefault(source["source_url"], []).append(source["passage"])
+        if citation_id not in used_ids:
+            used_ids.append(citation_id)
+        used_tokens += tokens
+
+    return "\n\n".join(blocks), used_ids, used_tokens
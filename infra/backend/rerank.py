@@ -0,0 +1,209 @@
+"""
+Optional reranking stage run between hybrid fusion and document selection.
+
+The reranker is chosen with RERANKER:
+    none     skip reranking (default)
+    stub     term-overlap scorer, useful for tests and local runs
+    bedrock  a Bedrock rerank model (RERANK_MODEL_ID)
+    local    a sentence-transformers cross-encoder (RERANK_MODEL_ID)
+"""
+
+import logging
+import math
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from botocore.config import Config
+
+from clients import boto_config, get_session
+
+logger = logging.getLogger()
+
+RERANKER = os.getenv("RERANKER", "none")
+RERANK_TOP_N = int(os.getenv("RERANK_TOP_N", "20"))
+RERANK_BUDGET_MS = int(os.getenv("RERANK_BUDGET_MS", "500"))
+# Workers reserved for reranking, so a reranker that overruns its budget
+# holds one of these rather than a worker the retrieval legs need
+RERANK_CONCURRENCY = int(os.getenv("RERANK_CONCURRENCY", "2"))
+
+
+class StubReranker:
+    """Scores passages by the share of query terms they contain."""
+
+    scores_are_logits = False
+
+    def score(self, query, passages):
+        terms = set(re.findall(r"\w+", query.lower()))
+        if not terms:
+            return [0.0] * len(passages)
+        return [
+            len(terms & set(re.findall(r"\w+", passage.lower()))) / len(terms)
+            for passage in passages
+        ]
+
+
+class BedrockReranker:
+    """Scores passages with a Bedrock rerank model through bedrock-agent-runtime."""
+
+    scores_are_logits = False
+
+    def __init__(self, model_id, budget_ms=RERANK_BUDGET_MS):
+        self.model_arn = (
+            f"arn:aws:bedrock:{os.getenv('AWS_REGION')}::foundation-model/{model_id}"
+        )
+        # A call past the latency budget is abandoned, so it is not retried
+        # and its connection is not held open waiting for the response
+        self.client = get_session().client(
+            "bedrock-agent-runtime",
+            config=boto_config.merge(
+                Config(
+                    read_timeout=max(budget_ms / 1000, 0.1),
+                    retries={"total_max_attempts": 1, "mode": "standard"},
+                )
+            ),
+        )
+
+    def score(self, query, passages):
+        response = self.client.rerank(
+            queries=[{"type": "TEXT", "textQuery": {"text": query}}],
+            sources=[
+                {
+                    "type": "INLINE",
+                    "inlineDocumentSource": {
+                        "type": "TEXT",
+                        "textDocument": {"text": passage},
+                    },
+                }
+                for passage in passages
+            ],
+            rerankingConfiguration={
+                "type": "BEDROCK_RERANKING_MODEL",
+                "bedrockRerankingConfiguration": {
+                    "numberOfResults": len(passages),
+                    "modelConfiguration": {"modelArn": self.model_arn},
+                },
+            },
+        )
+        scores = [0.0] * len(passages)
+        for result in response["results"]:
+            scores[result["index"]] = result["relevanceScore"]
+        return scores
+
+
+class LocalCrossEncoderReranker:
+    """Scores passages with a sentence-transformers cross-encoder in process."""
+
+    # ms-marco cross-encoders return unbounded logits, often all negative
+    scores_are_logits = True
+
+    def __init__(self, model_id):
+        # Optional dependency, only needed when this reranker is selected
+        from sentence_transformers import CrossEncoder
+
+        self.model = CrossEncoder(model_id)
+
+    def score(self, query, passages):
+        return self.model.predict([(query, passage) for passage in passages]).tolist()
+
+
+def build_reranker(name=RERANKER):
+    """Creates the reranker selected by name, or None to skip reranking."""
+    if name == "stub":
+        return StubReranker()
+    if name == "bedrock":
+        return BedrockReranker(os.getenv("RERANK_MODEL_ID", "amazon.rerank-v1:0"))
+    if name == "local":
+        return LocalCrossEncoderReranker(
+            os.getenv("RERANK_MODEL_ID", "cross-encoder/ms-marco-MiniLM-L-6-v2")
+        )
+    return None
+
+
+def normalize_scores(scores, logits):
+    """
+    Maps reranker scores into [0, 1] so the relative score-drop cutoff in
+    select_top_documents works as it does on fused scores. Logits go through
+    a sigmoid; scores that are already relevance probabilities are kept, and
+    anything else outside [0, 1] is min-max scaled.
+    """
+    if logits:
+        return [1 / (1 + math.exp(-min(max(score, -50.0), 50.0))) for score in scores]
+    low, high = min(scores), max(scores)
+    if low >= 0 and high <= 1:
+        return list(scores)
+    if high == low:
+        return [1.0] * len(scores)
+    return [(score - low) / (high - low) for score in scores]
+
+
+def rerank_results(query, hybrid_results, reranker, top_n=None, budget_ms=None):
+    """
+    Reorders the top fused candidates by reranker score.
+
+    Args:
+        query (str): The user query
+        hybrid_results (dict): Fused results in OpenSearch response format
+        reranker: Object with a score(query, passages) method
+        top_n (int): Number of fused candidates to rerank
+        budget_ms (int): Time the reranker may take before it is abandoned
+
+    Returns:
+        dict: The top_n candidates with their reranker scores mapped into
+            [0, 1], or the fused results unchanged if the reranker fails or
+            runs out of budget
+    """
+    if top_n is None:
+        top_n = RERANK_TOP_N
+    if budget_ms is None:
+        budget_ms = RERANK_BUDGET_MS
+
+    candidates = hybrid_results["hits"]["hits"][:top_n]
+    if reranker is None or len(candidates) < 2:
+        return hybrid_results
+
+    passages = [hit["_source"]["passage"] for hit in candidates]
+    future = get_rerank_executor().submit(reranker.score, query, passages)
+    try:
+        scores = future.result(timeout=budget_ms / 1000)
+    except TimeoutError:
+        logger.warning(f"Reranker exceeded {budget_ms} ms budget, keeping fused order")
+        return hybrid_results
+    except Exception as e:
+        logger.warning(f"Reranker failed, keeping fused order: {e}")
+        return hybrid_results
+
+    scores = normalize_scores(scores, getattr(reranker, "scores_are_logits", False))
+    reranked = [{**hit, "_score": score} for hit, score in zip(candidates, scores)]
+    reranked.sort(key=lambda hit: hit["_score"], reverse=True)
+    return {"hits": {"hits": reranked}}
+
+
+_reranker = {}
+_rerank_executor = {}
+_rerank_executor_lock = threading.Lock()
+
+
+def get_rerank_executor():
+    """Returns the thread pool reranking runs on, created once per container."""
+    with _rerank_executor_lock:
+        if "value" not in _rerank_executor:
+            _rerank_executor["value"] = ThreadPoolExecutor(
+                max_workers=RERANK_CONCURRENCY, thread_name_prefix="rerank"
+            )
+    return _rerank_executor["value"]
+
+
+def get_reranker():
+    """Returns the configured reranker, built once per container."""
+    if "value" not in _reranker:
+        start = time.perf_counter()
+        _reranker["value"] = build_reranker()
+        if _reranker["value"] is not None:
+            logger.info(
+                f"Loaded {RERANKER} reranker in "
+                f"{(time.perf_counter() - start) * 1000:.1f} ms"
+            )
+    return _reranker["value"]
@@ -1,26 +1,38 @@
 import numpy as np
-import boto3
+from clients import get_client
+from embedding_cache import cache_key, embedding_cache
 import json
 import os
 
+# Estimated tokens of passages sent to the chat model, shared by document
+# selection and prompt building so both trim to the same limit
+RETRIEVAL_TOKEN_BUDGET = int(os.getenv("RETRIEVAL_TOKEN_BUDGET", "4000"))
+
 
 def normalize_scores_(scores, normalizer):
     """
-    Normalize scores using L2/min-max normalization.
-    :param scores: The list of scores to normalize.
-    :param mormalizer: normalizing tekniq
-    :return: The normalized scores.
+    Normalize scores using min-max, L2 or z-score normalization.
+    :param scores: The list or array of scores to normalize.
+    :param normalizer: The normalization technique ("minmax", "l2" or "zscore").
+    :return: The normalized scores as a float array.
     """
-    if len(scores) == 0:
-        return np.array([])
+    scores = np.asarray(scores, dtype=np.float64)
+    if scores.size == 0:
+        return scores
     if "minmax" in normalizer:
-        scores = np.array(scores)
-        return (scores - np.min(scores)) / (np.max(scores) - np.min(scores))
+        spread = scores.max() - scores.min()
+        # Equal scores carry no ranking signal, treat them all as the best hit
+        if spread == 0:
+            return np.ones_like(scores)
+        return (scores - scores.min()) / spread
     elif "l2" in normalizer:
-        scores = np.array(scores)
-        return scores / np.linalg.norm(scores)
+        norm = np.linalg.norm(scores)
+        return scores / norm if norm else np.zeros_like(scores)
+    elif "zscore" in normalizer:
+        std = scores.std()
+        return (scores - scores.mean()) / std if std else np.zeros_like(scores)
     else:
-        raise "enter either minmax or l2 as normalizer"
+        raise ValueError("enter either minmax, l2 or zscore as normalizer")
 
 
 def interpolate_scores(lexical_score, semantic_score, alpha=0.5):
@@ -34,6 +46,82 @@ def interpolate_scores(lexical_score, semantic_score, alpha=0.5):
     return alpha * lexical_score + (1 - alpha) * semantic_score
 
 
+def fuse_results(
+    result_lists, weights=None, normalizer="minmax", top_K_results=None, rrf_k=60
+):
+    """
+    Fuse any number of OpenSearch result sets into one ranking.
+
+    With a score normalizer, each document gets the weighted mean of its
+    normalized scores over the result lists it appears in, so a document found
+    by a single list keeps that list's score. With "rrf", each document gets
+    the sum of 1 / (rrf_k + rank) over the lists it appears in.
+
+    :param result_lists: OpenSearch search responses to fuse.
+    :param weights: One weight per result list (default: equal weights).
+    :param normalizer: "minmax", "l2", "zscore" or "rrf".
+    :param top_K_results: Number of fused hits to return (default: all).
+    :param rrf_k: The rank constant for RRF (default: 60).
+    :return: The fused results in OpenSearch response format.
+    """
+    if weights is None:
+        weights = np.ones(len(result_lists))
+    weights = np.asarray(weights, dtype=np.float64)
+
+    # Assign every distinct document a row, keeping the first hit seen for it
+    rows = {}
+    hits = []
+    list_rows = []
+    list_scores = []
+    for results in result_lists:
+        list_hits = results["hits"]["hits"]
+        row_ids = np.empty(len(list_hits), dtype=np.int64)
+        for position, hit in enumerate(list_hits):
+            row = rows.get(hit["_id"])
+            if row is None:
+                row = rows[hit["_id"]] = len(hits)
+                hits.append(hit)
+            row_ids[position] = row
+        list_rows.append(row_ids)
+        list_scores.append([hit["_score"] for hit in list_hits])
+
+    if not hits:
+        return {"hits": {"hits": []}}
+
+    scores = np.zeros((len(hits), len(result_lists)))
+    present = np.zeros((len(hits), len(result_lists)), dtype=bool)
+    for column, (row_ids, raw_scores) in enumerate(zip(list_rows, list_scores)):
+        if normalizer == "rrf":
+            ranks = np.arange(1, len(row_ids) + 1)
+            scores[row_ids, column] = 1.0 / (rrf_k + ranks)
+        else:
+            scores[row_ids, column] = normalize_scores_(raw_scores, normalizer)
+        present[row_ids, column] = True
+
+    if normalizer == "rrf":
+        fused = scores @ weights
+    else:
+        total_weight = present @ weights
+        fused = np.divide(
+            scores @ weights,
+            total_weight,
+            out=np.zeros(len(hits)),
+            where=total_weight > 0,
+        )
+
+    if top_K_results is not None and top_K_results < len(fused):
+        top = np.argpartition(-fused, top_K_results - 1)[:top_K_results]
+    else:
+        top = np.arange(len(fused))
+    top = top[np.argsort(-fused[top], kind="stable")]
+
+    combined_results = [
+        {"_id": hits[row]["_id"], "_source": hits[row]["_source"], "_score": score}
+        for row, score in zip(top.tolist(), fused[top].tolist())
+    ]
+    return {"hits": {"hits": combined_results}}
+
+
 def reciprocal_rank_fusion(lexical_results, semantic_results, k=60):
     """
     Combine lexical and semantic search results using Reciprocal Rank Fusion (RRF).
@@ -42,32 +130,7 @@ def reciprocal_rank_fusion(lexical_results, semantic_results, k=60):
     :param k: The parameter for RRF (default: 60).
     :return: The combined search results.
     """
-    combined_results = {}
-
-    for hit in lexical_results["hits"]["hits"]:
-        doc_id = hit["_id"]
-        if doc_id not in combined_results:
-            combined_results[doc_id] = {
-                "_id": doc_id,
-                "_source": hit["_source"],
-                "_score": 0,
-            }
-        combined_results[doc_id]["_score"] += 1 / (k + hit["_score"])
-
-    for hit in semantic_results["hits"]["hits"]:
-        doc_id = hit["_id"]
-        if doc_id not in combined_results:
-            combined_results[doc_id] = {
-                "_id": doc_id,
-                "_source": hit["_source"],
-                "_score": 0,
-            }
-        combined_results[doc_id]["_score"] += 1 / (k + hit["_score"])
-
-    combined_results = list(combined_results.values())
-    combined_results = sorted(combined_results, key=lambda x: x["_score"], reverse=True)
-
-    return {"hits": {"hits": combined_results}}
+    return fuse_results([lexical_results, semantic_results], normalizer="rrf", rrf_k=k)
 
 
 def hybrid_search(
@@ -87,70 +150,39 @@ def hybrid_search(
     :param normalizer: The normalization function (default: minmax normalization).
     :return: The combined search results.
     """
+    return fuse_results(
+        [lexical_results, semantic_results],
+        weights=[interpolation_weight, 1 - interpolation_weight],
+        normalizer="rrf" if use_rrf else normalizer,
+        top_K_results=top_K_results,
+        rrf_k=rrf_k,
+    )
 
-    if use_rrf:
-        return reciprocal_rank_fusion(lexical_results, semantic_results, k=rrf_k)
 
-    combined_results = []
+def estimate_tokens(text):
+    """
+    Estimates the number of LLM tokens in a piece of text.
+    :param text: The text to measure.
+    :return: Roughly one token per four characters.
+    """
+    return len(text) // 4 + 1
 
-    # Normalize the scores from lexical and semantic searches
-    lexical_scores = [hit["_score"] for hit in lexical_results["hits"]["hits"]]
-    semantic_scores = [hit["_score"] for hit in semantic_results["hits"]["hits"]]
-    normalized_lexical_scores = normalize_scores_(lexical_scores, normalizer)
-    normalized_semantic_scores = normalize_scores_(semantic_scores, normalizer)
 
-    # Combine the results based on document IDs
-    lexical_docs = {
-        hit["_id"]: (hit, score)
-        for hit, score in zip(
-            lexical_results["hits"]["hits"], normalized_lexical_scores
-        )
-    }
-    semantic_docs = {
-        hit["_id"]: (hit, score)
-        for hit, score in zip(
-            semantic_results["hits"]["hits"], normalized_semantic_scores
-        )
-    }
-
-    for doc_id in set(lexical_docs.keys()) | set(semantic_docs.keys()):
-        lexical_hit, lexical_score = lexical_docs.get(doc_id, (None, 0))
-        semantic_hit, semantic_score = semantic_docs.get(doc_id, (None, 0))
-
-        if lexical_hit and semantic_hit:
-            # Interpolate scores if both lexical and semantic results are available
-            interpolated_score = interpolate_scores(
-                lexical_score, semantic_score, interpolation_weight
-            )
-            combined_hit = {
-                "_id": doc_id,
-                "_source": {**lexical_hit["_source"]},
-                "_score": interpolated_score,
-            }
-        elif lexical_hit:
-            # Use lexical hit if only lexical result is available
-            combined_hit = {
-                "_id": doc_id,
-                "_source": lexical_hit["_source"],
-                "_score": lexical_score,
-            }
-        else:
-            # Use semantic hit if only semantic result is available
-            combined_hit = {
-                "_id": doc_id,
-                "_source": semantic_hit["_source"],
-                "_score": semantic_score,
-            }
-        combined_results.append(combined_hit)
-    # Sort the combined results by the blended score
-    combined_results = sorted(
-        combined_results, key=lambda hit: hit["_score"], reverse=True
-    )
-    return {"hits": {"hits": combined_results[:top_K_results]}}
+def generate_text_embedding(message):
+    """
+    Embeds a query, serving repeated questions from the embedding cache.
+    :param message: The query text to embed.
+    :return: The embedding as a list of floats.
+    """
+    model_id = os.getenv("EMBEDDING_MODEL_ID")
+    key = cache_key(message, model_id)
 
+    cached = embedding_cache.get(key)
+    if cached is not None:
+        return cached.tolist()
 
-def generate_text_embedding(message):
-    response = boto3.client("bedrock-runtime").invoke_model(
-        modelId=os.getenv("EMBEDDING_MODEL_ID"), body=json.dumps({"inputText": message})
+    response = get_client("bedrock-runtime").invoke_model(
+        modelId=model_id, body=json.dumps({"inputText": message})
     )
-    return json.loads(response["body"].read())["embedding"]
+    embedding = json.loads(response["body"].read())["embedding"]
+    return embedding_cache.put(key, embedding).tolist()
@@ -0,0 +1,152 @@
+"""
+Long-running HTTP entry point for the chat backend.
+
+Serves POST /chat-response with the same request and response bodies as the
+API Gateway + Lambda path, but from a multi-worker process whose clients and
+connection pools live for the life of each worker. Requests are answered by
+chat_async.handle_chat, so a worker serves many requests concurrently.
+
+Usage:
+    cd infra/backend
+    python3 server.py
+
+    # or with uvicorn directly
+    uvicorn server:app --host 0.0.0.0 --port 8080 --workers 4
+
+SERVER_WORKERS, SERVER_HOST, SERVER_PORT and SERVER_KEEP_ALIVE configure
+python3 server.py. When SERVER_API_KEY is set, requests must send it in the
+x-api-key header, as API Gateway requires.
+
+Each worker is a separate process with its own in-memory state. With more
+than one worker, set CONVERSATION_TABLE so sessions are found whichever
+worker a request lands on, and EMBEDDING_CACHE_TABLE or EMBEDDING_CACHE_DIR
+so the workers share cached embeddings.
+"""
+
+import json
+import logging
+import os
+
+from answer_cache import ANSWER_CACHE_ENABLED
+from chat_async import close_clients, handle_chat
+from conversation import InMemoryConversationStore, conversation_store
+from embedding_cache import embedding_cache
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+SERVER_API_KEY = os.getenv("SERVER_API_KEY")
+MAX_BODY_BYTES = 64 * 1024
+
+
+def warn_about_worker_state(workers):
+    """Logs the in-memory state that more than one worker would split."""
+    if workers <= 1:
+        return
+    if isinstance(conversation_store, InMemoryConversationStore):
+        logger.warning(
+            f"{workers} workers share no conversation memory: a session is lost "
+            "whenever a request reaches another worker. Set CONVERSATION_TABLE "
+            "or run a single worker."
+        )
+    if embedding_cache.backend is None:
+        logger.warning(
+            f"Each of the {workers} workers keeps its own embedding cache. Set "
+            "EMBEDDING_CACHE_TABLE or EMBEDDING_CACHE_DIR to share it."
+        )
+    if ANSWER_CACHE_ENABLED:
+        logger.warning(f"Each of the {workers} workers keeps its own answer cache")
+
+
+async def read_body(receive):
+    """Reads the full request body, or None if it is too large."""
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if len(body) > MAX_BODY_BYTES:
+            return None
+        if not message.get("more_body"):
+            return body
+
+
+async def send_json(send, status_code, payload):
+    """Sends a JSON response the same way API Gateway returns the Lambda body."""
+    body = json.dumps(payload).encode("utf-8")
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status_code,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+            ],
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await close_clients()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    """ASGI application serving /chat-response and a /health check."""
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+
+    path = scope["path"].rstrip("/")
+    if path == "/health":
+        await send_json(send, 200, "ok")
+        return
+    if path != "/chat-response":
+        await send_json(send, 404, {"message": "Not Found"})
+        return
+    if scope["method"] != "POST":
+        await send_json(send, 405, {"message": "Method Not Allowed"})
+        return
+
+    if SERVER_API_KEY:
+        headers = dict(scope["headers"])
+        if headers.get(b"x-api-key", b"").decode() != SERVER_API_KEY:
+            await send_json(send, 403, {"message": "Forbidden"})
+            return
+
+    body = await read_body(receive)
+    if body is None:
+        await send_json(send, 413, {"message": "Request Entity Too Large"})
+        return
+    try:
+        body_data = json.loads(body)
+    except Exception as e:
+        logger.error(f"Invalid request body: {e}")
+        await send_json(send, 500, "Error processing message")
+        return
+
+    status_code, payload = await handle_chat(body_data)
+    await send_json(send, status_code, payload)
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    workers = int(os.getenv("SERVER_WORKERS", "4"))
+    warn_about_worker_state(workers)
+    uvicorn.run(
+        "server:app",
+        host=os.getenv("SERVER_HOST", "0.0.0.0"),
+        port=int(os.getenv("SERVER_PORT", "8080")),
+        workers=workers,
+        timeout_keep_alive=int(os.getenv("SERVER_KEEP_ALIVE", "75")),
+        log_level="info",
+    )
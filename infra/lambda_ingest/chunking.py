@@ -0,0 +1,369 @@
+import re
+from collections import Counter
+
+
+def find_chunk_end(markdown_text, current_position, total_length, n):
+    """
+    Finds where the chunk starting at current_position should end.
+
+    Prefers, in order, a paragraph break, a line break, a sentence end and a
+    word boundary at least n // 4 characters in, and never splits an image
+    tag. Only text before current_position + 1.5 * n is consulted, apart
+    from knowing whether the document goes on past it, so the search is
+    linear in the length of the document overall.
+
+    Args:
+        markdown_text (str): The document, or a window of it that starts at
+            or before current_position
+        current_position (int): Start of the chunk within markdown_text
+        total_length (int): Length of markdown_text
+        n (int): Target chunk size in characters
+
+    Returns:
+        int: The end of the chunk (exclusive)
+    """
+    # Calculate the initial chunk boundaries
+    chunk_end = min(current_position + n, total_length)
+
+    # If we're not at the end, try to find a good breaking point
+    if chunk_end < total_length:
+        # First, make sure we don't break in the middle of an image markdown
+        img_start = markdown_text.rfind("![", current_position, chunk_end)
+        if img_start != -1:
+            # A closing parenthesis past the 1.5 * n limit is treated the same
+            # as a missing one, so the search stops there instead of running
+            # to the end of the text for every chunk
+            img_end = markdown_text.find(
+                ")", img_start, current_position + n + n // 2 + 1
+            )
+            if img_end == -1 or img_end >= chunk_end:
+                # Image tag extends beyond our chunk - either extend the chunk or cut before the image
+                if (
+                    img_end != -1 and img_end < current_position + n * 1.5
+                ):  # Don't extend chunk too much
+                    chunk_end = img_end + 1
+                else:
+                    chunk_end = img_start
+
+        # If we're not at the end of a natural break, try to find one
+        if chunk_end < total_length:
+            # Look for paragraph breaks first
+            paragraph_break = markdown_text.rfind("\n\n", current_position, chunk_end)
+            if paragraph_break != -1 and paragraph_break > current_position + (
+                n // 4
+            ):  # Ensure substantial chunk
+                chunk_end = paragraph_break + 2
+            else:
+                # Try a line break
+                line_break = markdown_text.rfind("\n", current_position, chunk_end)
+                if line_break != -1 and line_break > current_position + (n // 4):
+                    chunk_end = line_break + 1
+                else:
+                    # Try a sentence break
+                    sentence_end = max(
+                        markdown_text.rfind(". ", current_position, chunk_end),
+                        markdown_text.rfind("! ", current_position, chunk_end),
+                        markdown_text.rfind("? ", current_position, chunk_end),
+                    )
+                    if sentence_end != -1 and sentence_end > current_position + (
+                        n // 4
+                    ):
+                        chunk_end = sentence_end + 2
+                    else:
+                        # If we can't find a good break, just use a word boundary
+                        space = markdown_text.rfind(" ", current_position, chunk_end)
+                        if space != -1 and space > current_position + (n // 4):
+                            chunk_end = space + 1
+
+    return chunk_end
+
+
+def next_chunk_position(current_position, chunk_end, total_length, n, overlap):
+    """Returns where the chunk after [current_position, chunk_end) starts."""
+    # Move to the next position, ensuring we make progress
+    next_position = chunk_end - overlap
+
+    # Ensure we're making significant progress to avoid tiny chunks
+    if next_position <= current_position:
+        # If we can't move forward with overlap, move by at least n/2 characters
+        next_position = current_position + max(n // 2, 1)
+
+    return min(next_position, total_length)  # Don't go beyond the end of the text
+
+
+def mark_document_chunks(markdown_text, n=3000, overlap=600):
+    """
+    Split a markdown document into chunks of approximately n characters with specified overlap,
+    while preserving markdown structure and ensuring image tags are not split.
+
+    Args:
+        markdown_text (str): The markdown text to split
+        n (int): Target chunk size in characters
+        overlap (int): Number of characters to overlap between chunks
+
+    Returns:
+        list: A list of markdown chunks
+    """
+    # Check if input is empty
+    if not markdown_text:
+        return []
+
+    chunks = []
+    current_position = 0
+    total_length = len(markdown_text)
+
+    # Ensure the chunk size is reasonable
+    if n <= overlap:
+        n = overlap * 2
+
+    while current_position < total_length:
+        chunk_end = find_chunk_end(markdown_text, current_position, total_length, n)
+
+        # Add the chunk to our list
+        chunks.append(markdown_text[current_position:chunk_end])
+
+        current_position = next_chunk_position(
+            current_position, chunk_end, total_length, n, overlap
+        )
+
+    return chunks
+
+
+def stream_document_chunks(pieces, n=3000, overlap=600):
+    """
+    Yields the same chunks as mark_document_chunks("".join(pieces), n, overlap)
+    without holding the whole document.
+
+    Only a window of about 1.5 * n characters past the current chunk start
+    is kept, which is all find_chunk_end looks at, so chunks are emitted as
+    soon as enough text has arrived to place their end.
+
+    Args:
+        pieces (iterable): Strings that make up the document, in order
+        n (int): Target chunk size in characters
+        overlap (int): Number of characters to overlap between chunks
+
+    Yields:
+        str: Markdown chunks, in document order
+    """
+    # Ensure the chunk size is reasonable
+    if n <= overlap:
+        n = overlap * 2
+    lookahead = n + n // 2 + 2
+
+    pieces = iter(pieces)
+    window = ""  # Text from the current chunk start onwards
+    exhausted = False
+
+    while True:
+        # Read ahead until the window covers everything find_chunk_end may use
+        if not exhausted and len(window) < lookahead:
+            parts = [window]
+            size = len(window)
+            while size < lookahead:
+                piece = next(pieces, None)
+                if piece is None:
+                    exhausted = True
+                    break
+                parts.append(piece)
+                size += len(piece)
+            window = "".join(parts)
+
+        if not window:
+            return
+
+        # Before the end of the document, the window stands in for the rest
+        # of it: every index find_chunk_end compares against lies inside it
+        total_length = len(window)
+        chunk_end = find_chunk_end(window, 0, total_length, n)
+        yield window[:chunk_end]
+
+        next_position = next_chunk_position(0, chunk_end, total_length, n, overlap)
+        window = window[next_position:]
+
+
+# Structure-aware chunking: a line is a heading when its font is this much
+# larger than the body text, or bold on its own when nothing else marks it
+HEADING_SIZE_RATIOS = [(1.6, 1), (1.3, 2), (1.15, 3)]
+BOLD_HEADING_LEVEL = 4
+HEADING_MAX_CHARS = 200
+
+# Bullets, "1." or "1)" and "a." or "a)" followed by a space start a list item
+LIST_ITEM_PATTERN = re.compile(
+    r"\s*(?:[•◦▪▫●○■□‣⁃∙·*–-]|\(?\d{1,3}[.)]|\(?[a-z][.)])\s"
+)
+
+
+def heading_level(line, body_size, lines_in_block):
+    """
+    Returns the heading level of a line, or None for body text.
+
+    Args:
+        line (dict): A line item with "text", "size" and "bold"
+        body_size (float): The most common font size in the document so far
+        lines_in_block (int): Number of lines in the line's text block
+    """
+    text = line["text"].strip()
+    if not text or len(text) > HEADING_MAX_CHARS or not body_size:
+        return None
+    for ratio, level in HEADING_SIZE_RATIOS:
+        if line["size"] >= body_size * ratio:
+            return level
+    # A bold paragraph is emphasis, a bold line on its own is a heading
+    if line["bold"] and lines_in_block == 1 and not LIST_ITEM_PATTERN.match(text):
+        return BOLD_HEADING_LEVEL
+    return None
+
+
+def iter_structure_units(items):
+    """
+    Groups the lines, images and tables of a document into structural units.
+
+    Consecutive lines of a text block form a paragraph, consecutive list
+    items (with the lines that continue them) form a list, and headings,
+    images and tables are units of their own. Items are read a page at a
+    time, so headings can be told from body text by the font sizes seen up
+    to the end of the current page.
+
+    Args:
+        items (iterable): Dicts with "type" ("line", "image" or "table"),
+            "text" and "page", and for lines also "block", "size" and "bold"
+
+    Yields:
+        dict: Units with "type" ("heading", "paragraph", "list", "image" or
+            "table"), "text" and "page", and "level" for headings
+    """
+    size_counts = Counter()
+    page = []
+
+    def page_units(page):
+        body_size = size_counts.most_common(1)[0][0] if size_counts else None
+        block_lines = Counter(item["block"] for item in page if item["type"] == "line")
+
+        unit = None
+        for item in page:
+            if item["type"] != "line":
+                if unit:
+                    yield unit
+                    unit = None
+                yield {"type": item["type"], "text": item["text"], "page": item["page"]}
+                continue
+
+            level = heading_level(item, body_size, block_lines[item["block"]])
+            text = item["text"]
+            if level is not None:
+                # Headings wrapped over several lines come back as one
+                if (
+                    unit
+                    and unit["type"] == "heading"
+                    and unit["level"] == level
+                    and unit["block"] == item["block"]
+                ):
+                    unit["text"] += " " + text.strip()
+                    continue
+                kind = "heading"
+            elif LIST_ITEM_PATTERN.match(text):
+                if unit and unit["type"] == "list":
+                    unit["text"] += "\n" + text
+                    unit["block"] = item["block"]
+                    continue
+                kind = "list"
+            elif unit and unit["type"] in ("paragraph", "list") and (
+                unit["block"] == item["block"]
+            ):
+                unit["text"] += "\n" + text
+                continue
+            else:
+                kind = "paragraph"
+
+            if unit:
+                yield unit
+            unit = {
+                "type": kind,
+                "text": text.strip() if kind == "heading" else text,
+                "page": item["page"],
+                "block": item["block"],
+            }
+            if kind == "heading":
+                unit["level"] = level
+        if unit:
+            yield unit
+
+    for item in items:
+        if page and item["page"] != page[0]["page"]:
+            yield from page_units(page)
+            page = []
+        if item["type"] == "line" and item["text"].strip():
+            size_counts[round(item["size"], 1)] += len(item["text"])
+        page.append(item)
+    if page:
+        yield from page_units(page)
+
+
+def stream_structure_chunks(items, n=3000, overlap=600):
+    """
+    Splits a document into chunks that follow its structure.
+
+    A chunk holds the units of one section, up to about n characters, and a
+    new heading always starts a new chunk. Tables and lists are kept whole
+    unless longer than 2 * n, in which case they are split at line breaks.
+    Paragraphs longer than n are split with mark_document_chunks, which is
+    the only place the overlap applies; units are not repeated across
+    chunks.
+
+    Args:
+        items (iterable): Document items, as taken by iter_structure_units
+        n (int): Target chunk size in characters
+        overlap (int): Number of characters to overlap within a long paragraph
+
+    Yields:
+        dict: Chunks with the "passage" text, the "heading_path" of the
+            section it is in and the "page_number" it starts on
+    """
+    headings = []  # (level, title) of the current section and its parents
+    parts = []
+    size = 0
+    has_body = False
+    page_number = None
+
+    def chunk():
+        return {
+            "passage": "\n".join(parts),
+            "heading_path": " > ".join(title for _, title in headings),
+            "page_number": page_number,
+        }
+
+    for unit in iter_structure_units(items):
+        if unit["type"] == "heading":
+            if has_body:
+                yield chunk()
+                parts, size, has_body = [], 0, False
+            while headings and headings[-1][0] >= unit["level"]:
+                headings.pop()
+            headings.append((unit["level"], unit["text"]))
+            if not parts:
+                page_number = unit["page"]
+            parts.append("#" * unit["level"] + " " + unit["text"])
+            size += len(parts[-1]) + 1
+            continue
+
+        text = unit["text"]
+        if unit["type"] == "paragraph" and len(text) > n:
+            pieces = mark_document_chunks(text, n, overlap)
+        elif unit["type"] in ("list", "table") and len(text) > 2 * n:
+            pieces = mark_document_chunks(text, n, 0)
+        else:
+            pieces = [text]
+
+        for piece in pieces:
+            if has_body and size + len(piece) > n:
+                yield chunk()
+                parts, size, has_body = [], 0, False
+            if not parts:
+                page_number = unit["page"]
+            parts.append(piece)
+            size += len(piece) + 1
+            has_body = True
+
+    if parts:
+        yield chunk()
@@ -1,135 +1,66 @@
 import pymupdf  # PyMuPDF
+import hashlib
 import os
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from PIL import Image
-import io
-from llm_utils import describe_image_with_claude
+from llm_utils import IMAGE_CONCURRENCY, describe_image_with_claude, llm_config
+from image_cache import build_image_cache, image_hash
 import boto3
 from urllib.parse import urlparse
-from opensearch_insert import insert_passage_opensearch
+from opensearch_insert import bulk_insert_passages, delete_chunks, source_query
+from chunking import stream_document_chunks, stream_structure_chunks
 
+# Image triage: blocks smaller than this (in PDF points) are icons, bullets
+# or rules, and renders with less entropy than this (in bits) are blank or
+# flat fills. Neither is worth a description.
+IMAGE_MIN_AREA = float(os.getenv("IMAGE_MIN_AREA", "1600"))
+IMAGE_MIN_SIDE = float(os.getenv("IMAGE_MIN_SIDE", "8"))
+IMAGE_MIN_ENTROPY = float(os.getenv("IMAGE_MIN_ENTROPY", "1.0"))
 
-def mark_document_chunks(markdown_text, n=3000, overlap=600):
-    """
-    Split a markdown document into chunks of approximately n characters with specified overlap,
-    while preserving markdown structure and ensuring image tags are not split.
+# Images are rendered at up to 4x, scaled down so they stay under this many
+# pixels, which is about the most the vision model uses without resizing
+IMAGE_MAX_SCALE = 4.0
+IMAGE_MAX_PIXELS = int(os.getenv("IMAGE_MAX_PIXELS", "1150000"))
 
-    Args:
-        markdown_text (str): The markdown text to split
-        n (int): Target chunk size in characters
-        overlap (int): Number of characters to overlap between chunks
+# "characters" splits the document text by size, "structure" splits it at
+# headings and keeps tables and lists whole, indexing each chunk's heading
+# path and page number
+CHUNKING_MODE = os.getenv("CHUNKING_MODE", "characters")
 
-    Returns:
-        list: A list of markdown chunks
-    """
-    # Check if input is empty
-    if not markdown_text:
-        return []
-
-    chunks = []
-    current_position = 0
-    total_length = len(markdown_text)
-
-    # Ensure the chunk size is reasonable
-    if n <= overlap:
-        n = overlap * 2
-
-    while current_position < total_length:
-        # Calculate the initial chunk boundaries
-        chunk_end = min(current_position + n, total_length)
-
-        # If we're not at the end, try to find a good breaking point
-        if chunk_end < total_length:
-            # First, make sure we don't break in the middle of an image markdown
-            img_start = markdown_text.rfind("![", current_position, chunk_end)
-            if img_start != -1:
-                img_end = markdown_text.find(")", img_start)
-                if img_end == -1 or img_end >= chunk_end:
-                    # Image tag extends beyond our chunk - either extend the chunk or cut before the image
-                    if (
-                        img_end != -1 and img_end < current_position + n * 1.5
-                    ):  # Don't extend chunk too much
-                        chunk_end = img_end + 1
-                    else:
-                        chunk_end = img_start
-
-            # If we're not at the end of a natural break, try to find one
-            if chunk_end < total_length:
-                # Look for paragraph breaks first
-                paragraph_break = markdown_text.rfind(
-                    "\n\n", current_position, chunk_end
-                )
-                if paragraph_break != -1 and paragraph_break > current_position + (
-                    n // 4
-                ):  # Ensure substantial chunk
-                    chunk_end = paragraph_break + 2
-                else:
-                    # Try a line break
-                    line_break = markdown_text.rfind("\n", current_position, chunk_end)
-                    if line_break != -1 and line_break > current_position + (n // 4):
-                        chunk_end = line_break + 1
-                    else:
-                        # Try a sentence break
-                        sentence_end = max(
-                            markdown_text.rfind(". ", current_position, chunk_end),
-                            markdown_text.rfind("! ", current_position, chunk_end),
-                            markdown_text.rfind("? ", current_position, chunk_end),
-                        )
-                        if sentence_end != -1 and sentence_end > current_position + (
-                            n // 4
-                        ):
-                            chunk_end = sentence_end + 2
-                        else:
-                            # If we can't find a good break, just use a word boundary
-                            space = markdown_text.rfind(
-                                " ", current_position, chunk_end
-                            )
-                            if space != -1 and space > current_position + (n // 4):
-                                chunk_end = space + 1
-
-        # Add the chunk to our list
-        current_chunk = markdown_text[current_position:chunk_end]
-        chunks.append(current_chunk)
-
-        # Move to the next position, ensuring we make progress
-        next_position = chunk_end - overlap
-
-        # Ensure we're making significant progress to avoid tiny chunks
-        if next_position <= current_position:
-            # If we can't move forward with overlap, move by at least n/2 characters
-            next_position = current_position + max(n // 2, 1)
-
-        current_position = min(
-            next_position, total_length
-        )  # Don't go beyond the end of the text
-
-    return chunks
-
-
-def save_image_to_s3(
-    image, file_name, page_num, image_num, bucket_name, folder="image_store"
-):
+_s3_lock = threading.Lock()
+_s3_client = None
+
+
+def get_s3_client():
+    """Returns the S3 client shared by the image worker threads."""
+    global _s3_client
+    with _s3_lock:
+        if _s3_client is None:
+            _s3_client = boto3.client("s3", config=llm_config)
+    return _s3_client
+
+
+def save_image_to_s3(image_png, image_id, bucket_name, folder="image_store"):
     """
-    Saves a PIL image to an S3 bucket and returns the S3 URI.
+    Saves a PNG image to an S3 bucket and returns the S3 URI.
 
-    :param image: PIL Image to save.
-    :param local_pdf_path: Path to the original PDF file.
+    :param image_png: PNG encoded image bytes to save.
+    :param image_id: Content hash of the image, used as its file name.
     :param bucket_name: S3 bucket name.
     :param folder: Folder path in the S3 bucket.
     :return: S3 URI of the uploaded image.
     """
-    s3_client = boto3.client("s3")
+    s3_client = get_s3_client()
 
-    buffered = io.BytesIO()
-    image.save(buffered, format="PNG")
-    buffered.seek(0)
+    image_filename = f"{folder}/{image_id}.png"
 
-    image_filename = f"{folder}/{file_name}_page_{page_num}_image_{image_num}.png"
-
-    s3_client.upload_fileobj(
-        buffered,
-        bucket_name,
-        image_filename,
-        ExtraArgs={"ContentType": "image/png"},
+    s3_client.put_object(
+        Body=image_png,
+        Bucket=bucket_name,
+        Key=image_filename,
+        ContentType="image/png",
     )
 
     # Construct and return the S3 URI
@@ -137,76 +68,272 @@ def save_image_to_s3(
     return s3_uri
 
 
-def process_image(page, block, model_id, image_count, pdf_path, bucket_name):
-    """Takes in an image block, saves it to s3, and returns the description and uri in markdown format."""
-    # Increase resolution with matrix parameter
-    matrix = pymupdf.Matrix(4.0, 4.0)
+def is_trivial_block(block):
+    """Checks whether an image block is too small or thin to describe."""
+    x0, y0, x1, y1 = block["bbox"]
+    width, height = x1 - x0, y1 - y0
+    return width * height < IMAGE_MIN_AREA or min(width, height) < IMAGE_MIN_SIDE
+
+
+def render_image(page, block):
+    """
+    Renders an image block of a page to PNG bytes.
+
+    The render scale adapts to the block size so large images stay under
+    IMAGE_MAX_PIXELS, and the image is encoded once here for both the S3
+    upload and the model call.
+
+    Returns:
+        bytes: The PNG image, or None if the render is blank or near uniform
+    """
+    rect = pymupdf.Rect(block["bbox"])
+    scale = min(
+        IMAGE_MAX_SCALE, (IMAGE_MAX_PIXELS / max(rect.width * rect.height, 1)) ** 0.5
+    )
 
-    # Get image with higher resolution
     pix = page.get_pixmap(
-        clip=pymupdf.Rect(block["bbox"]),
-        matrix=matrix,
+        clip=rect,
+        matrix=pymupdf.Matrix(scale, scale),
         alpha=False,  # Set to True if you need transparency
     )
 
-    # Convert pixmap to PIL Image
-    img_data = pix.samples
-    pil_image = Image.frombytes("RGB", [pix.width, pix.height], img_data)
+    grayscale = Image.frombytes("RGB", [pix.width, pix.height], pix.samples).convert(
+        "L"
+    )
+    if grayscale.entropy() < IMAGE_MIN_ENTROPY:
+        return None
+
+    return pix.tobytes("png")
+
 
-    # Optionally enhance the image quality
-    pil_image = pil_image.convert("RGB")
+def store_and_describe_image(image_png, image_id, model_id, bucket_name, image_cache):
+    """
+    Returns the description and s3 uri of an image in markdown format, from
+    the image cache if it was seen before, otherwise by saving it to s3 and
+    describing it.
+    """
+    cached = image_cache.get(image_id, model_id)
+    if cached:
+        return f"[{cached['description']}]({cached['image_uri']})"
 
-    file_name = os.path.basename(pdf_path).replace(" ", "_")
     image_uri = save_image_to_s3(
-        pil_image,
-        file_name,
-        page.number,
-        image_count,
+        image_png,
+        image_id,
         bucket_name,
         os.getenv("IMAGE_FOLDER_NAME"),
     )
 
-    image_description = describe_image_with_claude(pil_image, model_id)
+    image_description = describe_image_with_claude(image_png, model_id)
+
+    # Failed descriptions come back as an error dict and are not cached
+    if isinstance(image_description, str):
+        image_cache.put(image_id, model_id, image_description, image_uri)
 
     return f"[{image_description}]({image_uri})"
 
 
-def extract_lines_and_images(pdf_path, image_model_id, bucket_name):
+def process_image(
+    page, block, model_id, bucket_name, executor, slots, image_cache, pending
+):
+    """
+    Renders an image block and queues its upload and description.
+
+    Small, thin, blank and near uniform images are skipped. The rest are
+    identified by a hash of their embedded bytes: an image that already
+    appeared in this document reuses the future in `pending`, and one
+    described in an earlier document is served from `image_cache`.
+
+    PyMuPDF is not thread safe, so rendering stays on the calling thread and
+    only the S3 and Bedrock calls run on the executor. `slots` bounds how
+    many rendered images may wait for a worker, so rendering pauses while
+    Bedrock is throttling instead of piling images up in memory.
+
+    Returns:
+        Future: Resolves to the image markdown, or None if the image is skipped
+    """
+    if is_trivial_block(block):
+        return None
+
+    image_id = image_hash(block["image"])
+    if image_id in pending:
+        if pending[image_id] is not None:
+            image_cache.record_hit()
+        return pending[image_id]
+
+    image_png = render_image(page, block)
+    if image_png is None:
+        pending[image_id] = None
+        return None
+
+    slots.acquire()
+    future = executor.submit(
+        store_and_describe_image,
+        image_png,
+        image_id,
+        model_id,
+        bucket_name,
+        image_cache,
+    )
+    future.add_done_callback(lambda _: slots.release())
+    pending[image_id] = future
+    return future
+
+
+def is_bold(span):
+    """Checks whether a text span is set in a bold font."""
+    return bool(span["flags"] & pymupdf.TEXT_FONT_BOLD)
+
+
+def iter_document_items(
+    doc, image_model_id, bucket_name, image_cache, find_tables=False
+):
+    """
+    Yields the text lines and images of an open pdf, in document order,
+    with images as markdown with references to s3 image objects.
+
+    Pages are read one at a time while images are uploaded and described
+    on up to IMAGE_CONCURRENCY worker threads. After each page, the items
+    up to the first image still being described are yielded, so only the
+    items behind that image are held at once.
+
+    Items are dicts with "type" ("line", "image" or "table"), "text" and
+    the 1-based "page" number. Lines also carry the index of their text
+    "block" in the document, their largest font "size" and whether they
+    are "bold" throughout. With find_tables, tables found by PyMuPDF are
+    yielded as markdown in place of the lines inside them.
+    """
+    # Holds items whose text, for images, may be a future resolving to markdown
+    document_items = deque()
+    pending = {}
+    skipped_images = 0
+    block_index = 0
+    slots = threading.BoundedSemaphore(IMAGE_CONCURRENCY * 2)
+
+    def ready_items():
+        while document_items and not (
+            isinstance(document_items[0]["text"], Future)
+            and not document_items[0]["text"].done()
+        ):
+            yield resolve(document_items.popleft())
+
+    def resolve(item):
+        if isinstance(item["text"], Future):
+            item["text"] = item["text"].result()
+        return item
+
+    with ThreadPoolExecutor(max_workers=IMAGE_CONCURRENCY) as executor:
+        for page_index, page in enumerate(doc):
+            page_number = page_index + 1
+            # Get the page dictionary
+            page_dict = page.get_text("dict")
+            blocks = page_dict["blocks"]
+            table_rects = []
+            if find_tables:
+                tables = page.find_tables().tables
+                table_rects = [pymupdf.Rect(table.bbox) for table in tables]
+                blocks = blocks + [
+                    {"bbox": table.bbox, "table": table.to_markdown().strip()}
+                    for table in tables
+                ]
+            # Extract blocks in order they appear on the page
+            blocks = sorted(blocks, key=lambda b: (b["bbox"][1], b["bbox"][0]))
+            for block in blocks:
+                block_index += 1
+                # Text block
+                if "lines" in block:
+                    for line in block["lines"]:
+                        # Lines inside a table come with the table instead
+                        x0, y0, x1, y1 = line["bbox"]
+                        center = pymupdf.Point((x0 + x1) / 2, (y0 + y1) / 2)
+                        if any(center in rect for rect in table_rects):
+                            continue
+                        line_text = " ".join([span["text"] for span in line["spans"]])
+                        spans = [span for span in line["spans"] if span["text"].strip()]
+                        document_items.append(
+                            {
+                                "type": "line",
+                                "text": line_text,
+                                "page": page_number,
+                                "block": block_index,
+                                "size": max(
+                                    (span["size"] for span in spans), default=0
+                                ),
+                                "bold": bool(spans) and all(map(is_bold, spans)),
+                            }
+                        )
+                # Image block
+                elif "image" in block:
+                    image_markdown = process_image(
+                        page,
+                        block,
+                        image_model_id,
+                        bucket_name,
+                        executor,
+                        slots,
+                        image_cache,
+                        pending,
+                    )
+                    if image_markdown is None:
+                        skipped_images += 1
+                    else:
+                        document_items.append(
+                            {
+                                "type": "image",
+                                "text": image_markdown,
+                                "page": page_number,
+                            }
+                        )
+                # Table found by find_tables
+                elif "table" in block:
+                    document_items.append(
+                        {"type": "table", "text": block["table"], "page": page_number}
+                    )
+
+            yield from ready_items()
+
+        while document_items:
+            yield resolve(document_items.popleft())
+
+    if skipped_images:
+        print(f"Skipped {skipped_images} trivial images")
+
+
+def iter_document_lines(doc, image_model_id, bucket_name, image_cache):
+    """Yields the text of each line and image markdown of an open pdf, in order."""
+    for item in iter_document_items(doc, image_model_id, bucket_name, image_cache):
+        yield item["text"]
+
+
+def join_lines(lines):
+    """Yields lines with newlines between them, as pieces of "\\n".join(lines)."""
+    for i, line in enumerate(lines):
+        if i:
+            yield "\n"
+        yield line
+
+
+def extract_lines_and_images(pdf_path, image_model_id, bucket_name, image_cache=None):
     """
     Extract texts lines and images from pdf
     in markdown format with references to s3 image objects.
+
+    Returns the whole document as one string with its page count; the
+    ingest Lambda streams iter_document_lines instead.
     """
+    if image_cache is None:
+        image_cache = build_image_cache(bucket_name)
+
     # Open the PDF document
     doc = pymupdf.open(pdf_path)
-
-    image_count = 0  # Counter for naming image files
-
-    document_lines = []
-    for page_num, page in enumerate(doc):
-        # Get the page dictionary
-        page_dict = page.get_text("dict")
-        # Extract blocks in order they appear on the page
-        blocks = sorted(page_dict["blocks"], key=lambda b: (b["bbox"][1], b["bbox"][0]))
-        for block in blocks:
-            # Text block
-            if "lines" in block:
-                for line in block["lines"]:
-                    line_text = " ".join([span["text"] for span in line["spans"]])
-                    document_lines.append(line_text)
-            # Image block
-            elif "image" in block:
-                image_count += 1
-
-                image_markdown = process_image(
-                    page, block, image_model_id, image_count, pdf_path, bucket_name
-                )
-                document_lines.append(image_markdown)
-
     page_count = doc.page_count
 
+    markdown_text = "\n".join(
+        iter_document_lines(doc, image_model_id, bucket_name, image_cache)
+    )
+
     doc.close()
 
-    return "\n".join(document_lines), page_count
+    return markdown_text, page_count
 
 
 def download_from_s3_uri(s3_uri, local_directory="/tmp"):
@@ -250,7 +377,38 @@ def download_from_s3_uri(s3_uri, local_directory="/tmp"):
         raise
 
 
+def delete_document(event):
+    """
+    Removes every chunk indexed from a document, for event
+    {"action": "delete", "uri": ..., "opensearch_index": ...}.
+    """
+    try:
+        s3_uri = event["uri"]
+        opensearch_index = event["opensearch_index"]
+    except KeyError as e:
+        return {"statusCode": 400, "body": f"Missing required field: {str(e)}"}
+
+    result = delete_chunks(
+        os.getenv("OPENSEARCH_ENDPOINT"), opensearch_index, source_query(s3_uri)
+    )
+    if result["failed"]:
+        # Left in the manifest by the runner, so the delete is retried
+        message = (
+            f"Document {s3_uri}: {result['failed']} chunks failed to delete, "
+            f"{result['deleted']} deleted"
+        )
+        print(message)
+        return {"statusCode": 500, "body": message, **result}
+
+    message = f"Document {s3_uri} removed, {result['deleted']} chunks deleted"
+    print(message)
+    return {"statusCode": 200, "body": message, **result}
+
+
 def lambda_handler(event, context):
+    if event.get("action") == "delete":
+        return delete_document(event)
+
     try:
         s3_uri = event["uri"]
         bucket_name = event["bucket_name"]
@@ -260,36 +418,124 @@ def lambda_handler(event, context):
     except KeyError as e:
         return {"statusCode": 400, "body": f"Missing required field: {str(e)}"}
 
+    opensearch_endpoint = os.getenv("OPENSEARCH_ENDPOINT")
     local_pdf_path = download_from_s3_uri(s3_uri)
 
-    markdown_text, num_pages = extract_lines_and_images(
-        local_pdf_path, image_model_id, bucket_name
+    with open(local_pdf_path, "rb") as f:
+        content_hash = hashlib.file_digest(f, "sha256").hexdigest()
+
+    # An object rewritten with the same bytes keeps the chunks it has
+    if content_hash == event.get("previous_content_hash"):
+        os.remove(local_pdf_path)
+        message = f"Document {s3_uri} unchanged"
+        print(message)
+        return {
+            "statusCode": 200,
+            "body": message,
+            "unchanged": True,
+            "content_hash": content_hash,
+        }
+
+    # Chunks left by an earlier attempt at this version would be duplicated
+    strays = delete_chunks(
+        opensearch_endpoint, opensearch_index, source_query(s3_uri, content_hash)
     )
-
-    # Chunk larger docs, leave smaller docs as is
-    if num_pages > 2:
-        document_chunks = mark_document_chunks(
-            markdown_text, int(os.getenv("CHUNK_SIZE")), int(os.getenv("OVERLAP"))
+    if strays["deleted"]:
+        print(f"Deleted {strays['deleted']} chunks left by an earlier attempt")
+    if strays["failed"]:
+        os.remove(local_pdf_path)
+        message = (
+            f"Document {s3_uri}: {strays['failed']} chunks left by an earlier "
+            "attempt failed to delete"
+        )
+        print(message)
+        return {"statusCode": 500, "body": message}
+
+    image_cache = build_image_cache(bucket_name)
+    doc = pymupdf.open(local_pdf_path)
+    num_pages = doc.page_count
+
+    # Lines flow from the pdf into chunks and from chunks into embedding and
+    # indexing, so the document markdown is never held whole
+    if CHUNKING_MODE == "structure":
+        document_chunks = stream_structure_chunks(
+            iter_document_items(
+                doc, image_model_id, bucket_name, image_cache, find_tables=True
+            ),
+            int(os.getenv("CHUNK_SIZE")),
+            int(os.getenv("OVERLAP")),
         )
-        for chunk in document_chunks:
-            insert_passage_opensearch(
-                chunk,
-                s3_uri,
-                embedding_model_id,
-                os.getenv("OPENSEARCH_ENDPOINT"),
-                opensearch_index,
-            )
     else:
-        insert_passage_opensearch(
-            markdown_text,
-            s3_uri,
-            embedding_model_id,
-            os.getenv("OPENSEARCH_ENDPOINT"),
-            opensearch_index,
+        markdown_pieces = join_lines(
+            iter_document_lines(doc, image_model_id, bucket_name, image_cache)
         )
 
-    os.remove(local_pdf_path)
+        # Chunk larger docs, leave smaller docs as is
+        if num_pages > 2:
+            document_chunks = stream_document_chunks(
+                markdown_pieces,
+                int(os.getenv("CHUNK_SIZE")),
+                int(os.getenv("OVERLAP")),
+            )
+        else:
+            document_chunks = ["".join(markdown_pieces)]
+
+    indexing = bulk_insert_passages(
+        document_chunks,
+        s3_uri,
+        embedding_model_id,
+        opensearch_endpoint,
+        opensearch_index,
+        content_hash,
+    )
+    chunk_ids = indexing.pop("chunk_ids")
+    print(f"Image description cache: {image_cache.stats()}")
+    print(
+        f"Indexed {indexing['indexed']}/{indexing['indexed'] + indexing['failed']} chunks"
+    )
 
-    print(f"Document {s3_uri} proccessed successfully!")
+    doc.close()
+    os.remove(local_pdf_path)
 
-    return {"statusCode": 200, "body": f"Document {s3_uri} proccessed successfully!"}
+    if indexing["failed"]:
+        # Remove the chunks this attempt did index, so only the previous
+        # version stays searchable until this one indexes fully. Any that
+        # fail to delete are removed as strays when the document is retried
+        withdrawn = delete_chunks(
+            opensearch_endpoint, opensearch_index, source_query(s3_uri, content_hash)
+        )
+        print(f"Withdrew {withdrawn['deleted']} chunks of the incomplete version")
+        message = f"Document {s3_uri} proccessed, {indexing['failed']} chunks failed to index"
+    else:
+        replaced = delete_chunks(
+            opensearch_endpoint,
+            opensearch_index,
+            source_query(s3_uri, content_hash, other_versions=True),
+        )
+        if replaced["deleted"]:
+            print(f"Deleted {replaced['deleted']} chunks of the previous version")
+        if replaced["failed"]:
+            # Not recorded in the manifest by the runner, so the next run
+            # indexes this version again and retries the cleanup
+            message = (
+                f"Document {s3_uri} indexed, but {replaced['failed']} chunks of "
+                "the previous version failed to delete"
+            )
+            print(message)
+            return {
+                "statusCode": 500,
+                "body": message,
+                "image_cache": image_cache.stats(),
+                "indexing": indexing,
+            }
+        message = f"Document {s3_uri} proccessed successfully!"
+    print(message)
+
+    return {
+        "statusCode": 200,
+        "body": message,
+        "image_cache": image_cache.stats(),
+        "indexing": indexing,
+        "content_hash": content_hash,
+        "chunk_ids": chunk_ids,
+    }
@@ -0,0 +1,129 @@
+import hashlib
+import json
+import os
+import threading
+
+import boto3
+from botocore.exceptions import ClientError
+
+
+def image_hash(image_bytes):
+    """Returns the content hash an image is stored and cached under."""
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+class S3DescriptionStore:
+    """Keeps one small JSON object per image hash under a bucket prefix."""
+
+    def __init__(self, bucket_name, prefix):
+        self.bucket_name = bucket_name
+        self.prefix = prefix.rstrip("/")
+        self.s3_client = boto3.client("s3")
+
+    def get(self, key):
+        try:
+            response = self.s3_client.get_object(
+                Bucket=self.bucket_name, Key=f"{self.prefix}/{key}.json"
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                return None
+            raise
+        return json.loads(response["Body"].read())
+
+    def put(self, key, entry):
+        self.s3_client.put_object(
+            Bucket=self.bucket_name,
+            Key=f"{self.prefix}/{key}.json",
+            Body=json.dumps(entry),
+            ContentType="application/json",
+        )
+
+
+class LocalDescriptionStore:
+    """Local stand-in for S3DescriptionStore, one JSON file per image hash."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def get(self, key):
+        try:
+            with open(os.path.join(self.directory, f"{key}.json")) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, entry):
+        with open(os.path.join(self.directory, f"{key}.json"), "w") as f:
+            json.dump(entry, f)
+
+
+class ImageDescriptionCache:
+    """
+    Image descriptions keyed by content hash, shared across documents.
+
+    An entry holds the S3 URI the image was uploaded to and the description
+    a model wrote for it, so a repeated image needs neither an upload nor a
+    model call. Hits and misses are counted for the current document.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, model_id):
+        """Returns the cached entry for an image described by model_id, or None."""
+        try:
+            entry = self.store.get(key)
+        except Exception as e:
+            print(f"Reading image description cache failed: {e}")
+            entry = None
+        if entry is not None and entry.get("model_id") != model_id:
+            entry = None
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return entry
+
+    def put(self, key, model_id, description, image_uri):
+        try:
+            self.store.put(
+                key,
+                {
+                    "model_id": model_id,
+                    "description": description,
+                    "image_uri": image_uri,
+                },
+            )
+        except Exception as e:
+            print(f"Writing image description cache failed: {e}")
+
+    def record_hit(self):
+        """Counts an image repeated within the current document."""
+        with self._lock:
+            self.hits += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+def build_image_cache(bucket_name):
+    """Creates a cache for one document, stored locally if IMAGE_CACHE_DIR is set."""
+    if os.getenv("IMAGE_CACHE_DIR"):
+        store = LocalDescriptionStore(os.getenv("IMAGE_CACHE_DIR"))
+    else:
+        store = S3DescriptionStore(
+            bucket_name, os.getenv("IMAGE_CACHE_PREFIX", "image_cache/")
+        )
+    return ImageDescriptionCache(store)
@@ -1,34 +1,93 @@
 from typing import Optional
 import boto3
 import json
+import os
+import threading
 import time
 from botocore.exceptions import ClientError
-import io
 import base64
 from botocore.config import Config
 
-llm_config = Config(read_timeout=1200)
+# Number of images uploaded and described at the same time
+IMAGE_CONCURRENCY = int(os.getenv("IMAGE_CONCURRENCY", "4"))
 
+llm_config = Config(read_timeout=1200, max_pool_connections=max(10, IMAGE_CONCURRENCY))
 
-def describe_image_with_claude(image, model_id, max_tokens=1000):
+_client_lock = threading.Lock()
+_bedrock_client = None
+
+
+def get_bedrock_client():
+    """Returns the Bedrock runtime client shared by every worker thread."""
+    global _bedrock_client
+    with _client_lock:
+        if _bedrock_client is None:
+            _bedrock_client = boto3.client("bedrock-runtime", config=llm_config)
+    return _bedrock_client
+
+
+class Throttle:
+    """
+    Back-off shared by every thread calling Bedrock.
+
+    When one call is throttled, every caller pauses until the back-off has
+    passed, so concurrent workers slow down together instead of each
+    retrying into the same limit.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._resume_at = 0.0
+
+    def wait(self):
+        """Sleeps until any active back-off has passed."""
+        delay = self._resume_at - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def back_off(self, seconds):
+        """Pauses all callers for at least `seconds` from now."""
+        with self._lock:
+            self._resume_at = max(self._resume_at, time.monotonic() + seconds)
+
+
+bedrock_throttle = Throttle()
+
+
+class RateLimiter:
+    """Spaces out calls so at most `rate` start per second across all threads."""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate > 0 else 0
+        self._lock = threading.Lock()
+        self._next_start = 0.0
+
+    def acquire(self):
+        """Sleeps until the caller's turn to start a call."""
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_start)
+            self._next_start = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+def describe_image_with_claude(image_png, model_id, max_tokens=1000):
     """
-    Invokes Claude with a multimodal prompt to describe a PIL Image.
+    Invokes Claude with a multimodal prompt to describe a PNG image.
     Implements a simple exponential backoff for handling transient errors.
 
     Args:
-        image (PIL.Image): The image to be described.
+        image_png (bytes): The PNG encoded image to be described, the same
+            bytes that are uploaded to S3.
         max_tokens (int, optional): The maximum number of tokens to generate. Default is 500.
 
     Returns:
         dict: The response from Claude, or an error message if the call fails.
     """
-    bedrock_session = boto3.session.Session()
-    client = bedrock_session.client("bedrock-runtime")
+    client = get_bedrock_client()
 
-    # Convert image to base64
-    buffered = io.BytesIO()
-    image.save(buffered, format="PNG")
-    image_base64 = base64.b64encode(buffered.getvalue()).decode("utf-8")
+    image_base64 = base64.b64encode(image_png).decode("utf-8")
 
     message = {
         "role": "user",
@@ -57,6 +116,7 @@ def describe_image_with_claude(image, model_id, max_tokens=1000):
     )
 
     for attempt in range(5):  # Retry up to 5 times
+        bedrock_throttle.wait()
         try:
             response = client.invoke_model(body=body, modelId=model_id)
             response_body = json.loads(response.get("body").read())
@@ -66,9 +126,9 @@ def describe_image_with_claude(image, model_id, max_tokens=1000):
                 "ThrottlingException",
                 "ServiceUnavailableException",
             ]:
-                time.sleep(
+                bedrock_throttle.back_off(
                     2**attempt
-                )  # Simple exponential backoff (1, 2, 4, 8, 16 sec)
+                )  # Simple exponential backoff (1, 2, 4, 8, 16 sec), shared by all workers
             else:
                 return {"error": err.response["Error"].get("Message", "Unknown error")}
 
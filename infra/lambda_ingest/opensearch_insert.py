@@ -1,50 +1,283 @@
 import boto3
-from langchain_aws import BedrockEmbeddings
-from opensearchpy import OpenSearch, RequestsHttpConnection, AWSV4SignerAuth
+import hashlib
+import json
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+from opensearchpy import OpenSearch, RequestsHttpConnection, AWSV4SignerAuth, helpers
 import os
+from llm_utils import RateLimiter, bedrock_throttle, get_bedrock_client
+
+# Embedding calls in flight at once, and started per second, per document
+EMBEDDING_CONCURRENCY = int(os.getenv("EMBEDDING_CONCURRENCY", "8"))
+EMBEDDING_RATE = float(os.getenv("EMBEDDING_RATE", "20"))
+
+# Bulk requests are cut at whichever limit is reached first
+BULK_MAX_DOCS = int(os.getenv("BULK_MAX_DOCS", "100"))
+BULK_MAX_BYTES = int(os.getenv("BULK_MAX_BYTES", str(5 * 1024 * 1024)))
+
+embedding_rate_limiter = RateLimiter(EMBEDDING_RATE)
+
+_client_lock = threading.Lock()
+_opensearch_clients = {}
+
+
+def get_opensearch_client(opensearch_endpoint):
+    """Returns an OpenSearch client for the endpoint, created once per container."""
+    with _client_lock:
+        client = _opensearch_clients.get(opensearch_endpoint)
+        if client is None:
+            credentials = boto3.Session().get_credentials()
+            auth = AWSV4SignerAuth(credentials, os.getenv("AWS_REGION"), "aoss")
+
+            client = OpenSearch(
+                hosts=[{"host": opensearch_endpoint, "port": 443}],
+                http_auth=auth,
+                use_ssl=True,
+                verify_certs=True,
+                connection_class=RequestsHttpConnection,
+                pool_maxsize=EMBEDDING_CONCURRENCY,
+                # Throttled bulk requests are retried whole by the transport
+                retry_on_status=(429, 502, 503, 504),
+                max_retries=3,
+            )
+            _opensearch_clients[opensearch_endpoint] = client
+    return client
+
+
+def chunk_id(source_uri, content_hash, position):
+    """Returns the id of a chunk, the same each time a document version is chunked."""
+    key = f"{source_uri}\n{content_hash}\n{position}"
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:32]
 
 
 def generate_embedding(passage, model_id):
     """Generates an embedding vector given text"""
-    embeddings_client = BedrockEmbeddings(model_id=model_id)
+    # Newlines are replaced as BedrockEmbeddings did, so vectors match
+    # passages indexed before
+    body = json.dumps({"inputText": passage.replace(os.linesep, " ")})
 
-    embedding = embeddings_client.embed_query(passage)
-    return embedding
+    for attempt in range(5):  # Retry up to 5 times
+        embedding_rate_limiter.acquire()
+        bedrock_throttle.wait()
+        try:
+            response = get_bedrock_client().invoke_model(
+                modelId=model_id,
+                body=body,
+                accept="application/json",
+                contentType="application/json",
+            )
+            return json.loads(response["body"].read())["embedding"]
+        except ClientError as err:
+            if attempt < 4 and err.response["Error"].get("Code") in [
+                "ThrottlingException",
+                "ServiceUnavailableException",
+            ]:
+                bedrock_throttle.back_off(2**attempt)
+            else:
+                raise
 
 
-def insert_into_opensearch(document, opensearch_endpoint, opensearch_index):
-    """Inserts a dictionary of information (document) into opensearch"""
-    service = "aoss"
+def passage_text(passage):
+    """Returns the text of a passage given as a string or a dict of fields."""
+    return passage["passage"] if isinstance(passage, dict) else passage
 
-    session = boto3.Session()
-    credentials = session.get_credentials()
-    auth = AWSV4SignerAuth(credentials, os.getenv("AWS_REGION"), service)
 
-    client = OpenSearch(
-        hosts=[{"host": opensearch_endpoint, "port": 443}],
-        http_auth=auth,
-        use_ssl=True,
-        verify_certs=True,
-        connection_class=RequestsHttpConnection,
-    )
+def embed_passages(passages, model_id):
+    """
+    Embeds passages concurrently on up to EMBEDDING_CONCURRENCY threads.
+
+    Passages are read from the iterable only as fast as they are embedded,
+    with at most 2 * EMBEDDING_CONCURRENCY in flight.
+
+    Yields:
+        tuple: Each passage, in order, with its embedding or the exception
+            raised while embedding it
+    """
 
-    response = client.index(index=opensearch_index, body=document)
+    def embed(passage):
+        try:
+            return generate_embedding(passage_text(passage), model_id)
+        except Exception as e:
+            return e
 
+    in_flight = deque()
+    with ThreadPoolExecutor(max_workers=EMBEDDING_CONCURRENCY) as executor:
+        for passage in passages:
+            in_flight.append((passage, executor.submit(embed, passage)))
+            if len(in_flight) >= EMBEDDING_CONCURRENCY * 2:
+                passage, future = in_flight.popleft()
+                yield passage, future.result()
+        while in_flight:
+            passage, future = in_flight.popleft()
+            yield passage, future.result()
 
-def insert_passage_opensearch(
-    passage, source_uri, model_id, opensearch_endpoint, opensearch_index
+
+def bulk_insert_passages(
+    passages,
+    source_uri,
+    model_id,
+    opensearch_endpoint,
+    opensearch_index,
+    content_hash=None,
 ):
-    """Takes in a text passage and inserts it into OpenSearch"""
-    try:
-        embedding = generate_embedding(passage, model_id)
-
-        # Preparing document for OpenSearch
-        document = {
-            "passage": passage,
-            "source_url": source_uri,
-            "embedding": embedding,
+    """
+    Embeds text passages and writes them to OpenSearch with the _bulk API.
+
+    Passages may be any iterable, such as a generator of chunks still being
+    extracted; each is indexed as soon as a bulk request fills up. A passage
+    is either its text or a dict with the text under "passage" and other
+    fields to index with it, such as "heading_path" and "page_number". Bulk
+    requests hold at most BULK_MAX_DOCS passages and BULK_MAX_BYTES of
+    payload. A passage that fails to embed or index is reported without
+    stopping the rest.
+
+    With the content_hash of the document, each passage is also indexed with
+    it and with a chunk_id derived from it, so the chunks of one version of
+    a document can be told from those of another. The ids are kept in a
+    field rather than used as document _ids, which OpenSearch Serverless
+    vector search collections do not accept.
+
+    Returns:
+        dict: The number of passages indexed, the chunk ids of those indexed
+            and an error per failed passage
+    """
+    errors = []
+    chunk_ids = []
+    # Positions of the passages sent to streaming_bulk and not yet reported
+    positions = deque()
+
+    def actions():
+        embedded = embed_passages(passages, model_id)
+        for position, (passage, embedding) in enumerate(embedded):
+            if isinstance(embedding, Exception):
+                errors.append(
+                    {"chunk": position, "error": f"Embedding failed: {embedding}"}
+                )
+                continue
+            positions.append(position)
+            fields = passage if isinstance(passage, dict) else {"passage": passage}
+            if content_hash is not None:
+                fields = {
+                    **fields,
+                    "content_hash": content_hash,
+                    "chunk_id": chunk_id(source_uri, content_hash, position),
+                }
+            yield {
+                "_index": opensearch_index,
+                "_source": {
+                    **fields,
+                    "source_url": source_uri,
+                    "embedding": embedding,
+                },
+            }
+
+    indexed = 0
+    results = helpers.streaming_bulk(
+        get_opensearch_client(opensearch_endpoint),
+        actions(),
+        chunk_size=BULK_MAX_DOCS,
+        max_chunk_bytes=BULK_MAX_BYTES,
+        raise_on_error=False,
+        raise_on_exception=False,
+    )
+    # Without per-item retries, results come back in the order actions were sent
+    for ok, item in results:
+        position = positions.popleft()
+        if ok:
+            indexed += 1
+            if content_hash is not None:
+                chunk_ids.append(chunk_id(source_uri, content_hash, position))
+        else:
+            error = next(iter(item.values())).get("error")
+            errors.append({"chunk": position, "error": f"Indexing failed: {error}"})
+
+    errors.sort(key=lambda error: error["chunk"])
+    for error in errors:
+        print(f"Inserting chunk {error['chunk']} of {source_uri} failed: {error['error']}")
+
+    return {
+        "indexed": indexed,
+        "failed": len(errors),
+        "errors": errors,
+        "chunk_ids": chunk_ids,
+    }
+
+
+def delete_chunks(opensearch_endpoint, opensearch_index, query, batch_size=500):
+    """
+    Deletes the chunks matching a query with the _bulk API.
+
+    Matches are looked up and deleted a batch at a time, excluding those
+    already handled, as deletes may take a moment to leave search results.
+    A chunk that is already gone (404) counts as deleted.
+
+    Returns:
+        dict: The number of chunks "deleted" and the number that "failed"
+    """
+    client = get_opensearch_client(opensearch_endpoint)
+    deleted = []
+    failed = []
+    while True:
+        response = client.search(
+            index=opensearch_index,
+            body={
+                "_source": False,
+                "size": batch_size,
+                "query": {
+                    "bool": {
+                        "filter": [query],
+                        "must_not": [{"ids": {"values": deleted + failed}}],
+                    }
+                },
+            },
+        )
+        ids = [hit["_id"] for hit in response["hits"]["hits"]]
+        if not ids:
+            break
+        _, errors = helpers.bulk(
+            client,
+            (
+                {"_op_type": "delete", "_index": opensearch_index, "_id": _id}
+                for _id in ids
+            ),
+            raise_on_error=False,
+        )
+        errors = {
+            error["delete"]["_id"]: error["delete"]
+            for error in errors
+            if error["delete"].get("status") != 404
         }
+        for _id in ids:
+            if _id in errors:
+                failed.append(_id)
+            else:
+                deleted.append(_id)
+        for _id, error in errors.items():
+            print(f"Deleting chunk {_id} failed: {error.get('error')}")
+
+    return {"deleted": len(deleted), "failed": len(failed)}
+
+
+def source_query(source_uri, content_hash=None, other_versions=False):
+    """
+    Builds a query for the chunks of a document.
+
+    Args:
+        source_uri (str): The document's S3 URI
+        content_hash (str): Only match chunks of this version of the document
+        other_versions (bool): Match chunks of every version but content_hash
+            instead, including chunks indexed without a content hash
 
-        insert_into_opensearch(document, opensearch_endpoint, opensearch_index)
-    except Exception as e:
-        print(f"Inserting {source_uri} into opensearch failed due to {e}")
+    Returns:
+        dict: An OpenSearch query
+    """
+    query = {"bool": {"filter": [{"term": {"source_url.keyword": source_uri}}]}}
+    if content_hash is not None:
+        # match is exact for a hex digest whether content_hash was mapped as
+        # a keyword or dynamically as text
+        version = {"match": {"content_hash": content_hash}}
+        clause = "must_not" if other_versions else "filter"
+        query["bool"].setdefault(clause, []).append(version)
+    return query
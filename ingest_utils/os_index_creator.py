@@ -14,19 +14,28 @@ domain_endpoint = config["opensearch_endpoint"]
 
 region = config["region"]
 
-credentials = boto3.Session().get_credentials()
-awsauth = AWSV4SignerAuth(credentials, region, service)
+# Optional overrides for testing against a local OpenSearch container
+port = config.get("opensearch_port", 443)
+use_ssl = config.get("opensearch_use_ssl", True)
+
+if config.get("opensearch_auth") == "none":
+    awsauth = None
+else:
+    credentials = boto3.Session().get_credentials()
+    awsauth = AWSV4SignerAuth(credentials, region, service)
+
 os_ = OpenSearch(
-    hosts=[{"host": domain_endpoint, "port": 443}],
+    hosts=[{"host": domain_endpoint, "port": port}],
     http_auth=awsauth,
-    use_ssl=True,
-    verify_certs=True,
+    use_ssl=use_ssl,
+    verify_certs=use_ssl,
     timeout=300,
     # http_compress = True, # enables gzip compression for request bodies
     connection_class=RequestsHttpConnection,
 )
 
 mapping = {
+    "settings": {"index": {"knn": True}},
     "mappings": {
         "properties": {
             "passsage": {
@@ -47,6 +56,15 @@ mapping = {
                 "type": "text",
                 "fields": {"keyword": {"type": "keyword"}},
             },
+            # Set by chunking_mode: structure
+            "heading_path": {
+                "type": "text",
+                "fields": {"keyword": {"type": "keyword"}},
+            },
+            "page_number": {"type": "integer"},
+            # Identify the document version a chunk was indexed from
+            "content_hash": {"type": "keyword"},
+            "chunk_id": {"type": "keyword"},
         }
     }
 }
@@ -63,3 +81,38 @@ def check_create_index(domain_index):
             print(f"Failed to create index '{domain_index}'.")
     else:
         print(f"Index {domain_index} already exists!")
+
+
+# Normalizes and fuses the two sub-queries of a hybrid query server-side
+search_pipeline = {
+    "description": "Min-max normalization and weighted mean for hybrid queries",
+    "phase_results_processors": [
+        {
+            "normalization-processor": {
+                "normalization": {"technique": "min_max"},
+                "combination": {
+                    "technique": "arithmetic_mean",
+                    "parameters": {"weights": [0.5, 0.5]},
+                },
+            }
+        }
+    ],
+}
+
+
+def check_create_search_pipeline(pipeline_name):
+    """Creates or updates the hybrid search pipeline used by RETRIEVAL_MODE=pipeline."""
+    try:
+        os_.transport.perform_request(
+            "PUT", f"/_search/pipeline/{pipeline_name}", body=search_pipeline
+        )
+        print(f"Search pipeline {pipeline_name} ready.")
+    except Exception as e:
+        # Clusters without the neural-search plugin keep client-side fusion
+        print(f"Could not create search pipeline '{pipeline_name}': {e}")
+
+
+if __name__ == "__main__":
+    check_create_index(config["opensearch_index_name"])
+    if config.get("retrieval_mode") == "pipeline":
+        check_create_search_pipeline(config["search_pipeline_name"])
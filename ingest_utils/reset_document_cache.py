@@ -8,7 +8,8 @@ config = yaml.safe_load(open("../config.yaml"))
 
 def reset_processed_uris_cache(bucket_name: str) -> None:
     """
-    Deletes and recreates the processed URIs cache file in S3.
+    Deletes and recreates the processed URIs cache file in S3, and deletes
+    the ingest manifest.
 
     Args:
         bucket_name (str): Name of the S3 bucket
@@ -29,6 +30,11 @@ def reset_processed_uris_cache(bucket_name: str) -> None:
         s3.put_object(Bucket=bucket_name, Key=key, Body="")
         print(f"Created new empty cache file: {key}")
 
+        # Without a manifest, every document is ingested again on the next run
+        manifest_key = config.get("ingest_manifest_file", "ingest_manifest.json")
+        s3.delete_object(Bucket=bucket_name, Key=manifest_key)
+        print(f"Deleted ingest manifest: {manifest_key}")
+
     except Exception as e:
         print(f"Error resetting URI cache file: {str(e)}")
 
@@ -1,17 +1,18 @@
 """
 Script to run document ingest on lambdas.
-For every document in your s3 bucket's ingest folder a
-new lambda will be spawned to process it.
+For every new or changed document in your s3 bucket's ingest folder a
+new lambda will be spawned to process it, and the chunks of documents
+removed from the folder are deleted from the index by the same lambda.
 """
 
 import aioboto3
 import asyncio
 import json
-from os_index_creator import check_create_index
+from os_index_creator import check_create_index, check_create_search_pipeline
 import yaml
 from botocore.config import Config
 import boto3
-from typing import List, Set
+from typing import Dict, List, Set, Tuple
 import os
 from datetime import datetime
 
@@ -29,35 +30,53 @@ os.environ["AWS_DEFAULT_REGION"] = config["region"]
 function_name = config["ingest_lambda_name"]
 
 
-def list_s3_pdfs(bucket_name: str, prefix: str) -> List[str]:
+def list_s3_pdf_objects(bucket_name: str, prefix: str) -> Dict[str, dict]:
     """
-    List all PDF file URIs in a given S3 bucket folder (prefix).
+    List all PDF files in a given S3 bucket folder (prefix) with their
+    ETag and size.
 
     Args:
         bucket_name (str): Name of the S3 bucket.
         prefix (str): Folder path within the bucket (with trailing slash).
 
     Returns:
-        List[str]: List of S3 URIs ending in .pdf
+        Dict[str, dict]: ETag and size of each PDF, keyed by S3 URI
     """
     s3 = boto3.client("s3")
     paginator = s3.get_paginator("list_objects_v2")
     pages = paginator.paginate(Bucket=bucket_name, Prefix=prefix)
 
-    uris = []
+    objects = {}
     for page in pages:
         for obj in page.get("Contents", []):
             key = obj["Key"]
             if key.lower().endswith(".pdf"):
-                uris.append(f"s3://{bucket_name}/{key}")
+                objects[f"s3://{bucket_name}/{key}"] = {
+                    "etag": obj["ETag"].strip('"'),
+                    "size": obj["Size"],
+                }
 
-    return uris
+    return objects
+
+
+def list_s3_pdfs(bucket_name: str, prefix: str) -> List[str]:
+    """
+    List all PDF file URIs in a given S3 bucket folder (prefix).
+
+    Args:
+        bucket_name (str): Name of the S3 bucket.
+        prefix (str): Folder path within the bucket (with trailing slash).
+
+    Returns:
+        List[str]: List of S3 URIs ending in .pdf
+    """
+    return list(list_s3_pdf_objects(bucket_name, prefix))
 
 
 def get_previously_processed_uris(bucket_name: str) -> Set[str]:
     """
-    Get the set of URIs that were previously successfully processed.
-    Creates the cache file in S3 if it does not exist.
+    Get the set of URIs listed as processed in the ingest cache file,
+    which recorded ingested documents before the manifest did.
 
     Args:
         bucket_name (str): Name of the S3 bucket
@@ -69,9 +88,6 @@ def get_previously_processed_uris(bucket_name: str) -> Set[str]:
     key = config["ingest_cache_file"]
 
     try:
-        s3.head_object(Bucket=bucket_name, Key=key)
-
-        # File exists, get its content
         response = s3.get_object(Bucket=bucket_name, Key=key)
         content = response["Body"].read().decode("utf-8")
         uris = set(line.strip() for line in content.splitlines() if line.strip())
@@ -80,10 +96,7 @@ def get_previously_processed_uris(bucket_name: str) -> Set[str]:
         return uris
 
     except s3.exceptions.ClientError as e:
-        if e.response["Error"]["Code"] == "404":
-            print("No previous successful URIs file found. Creating an empty one...")
-            s3.put_object(Bucket=bucket_name, Key=key, Body="")  # create empty file
-        else:
+        if e.response["Error"]["Code"] not in ("NoSuchKey", "404"):
             print(f"Error checking successful URIs file: {str(e)}")
         return set()
 
@@ -92,51 +105,99 @@ def get_previously_processed_uris(bucket_name: str) -> Set[str]:
         return set()
 
 
-def update_successful_uris(
-    bucket_name: str,
-    new_successful_uris: List[str],
-    previously_processed: Set[str] = None,
-) -> None:
+def load_manifest(bucket_name: str) -> Dict[str, dict]:
     """
-    Update the list of successfully processed URIs in S3.
+    Load the ingest manifest from S3.
+
+    The manifest holds, for each ingested PDF, the ETag and size its S3
+    object had, the SHA-256 of its content and the ids of the chunks
+    indexed from it. Without a manifest, the PDFs in the ingest cache file
+    are taken as ingested and unchanged, with their ETag and size unknown.
 
     Args:
         bucket_name (str): Name of the S3 bucket
-        new_successful_uris (List[str]): List of newly successful URI strings
-        previously_processed (Set[str]): Previously processed URIs to include
+
+    Returns:
+        Dict[str, dict]: Manifest entries keyed by S3 URI
     """
-    # Combine new successful URIs with previously processed URIs
-    all_successful = set(new_successful_uris)
-    if previously_processed:
-        all_successful.update(previously_processed)
+    s3 = boto3.client("s3")
+    key = config.get("ingest_manifest_file", "ingest_manifest.json")
 
-    # Convert to sorted list for consistent output
-    all_successful_list = sorted(all_successful)
+    try:
+        response = s3.get_object(Bucket=bucket_name, Key=key)
+        manifest = json.loads(response["Body"].read())
+        print(f"Found {len(manifest)} documents in the ingest manifest")
+        return manifest
+
+    except s3.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] not in ("NoSuchKey", "404"):
+            raise
 
-    # Join URIs with newlines
-    content = "\n".join(all_successful_list)
+    print("No ingest manifest found, starting from the ingest cache file")
+    return {
+        uri: {"etag": None, "size": None, "content_hash": None, "chunk_ids": []}
+        for uri in get_previously_processed_uris(bucket_name)
+    }
+
+
+def save_manifest(bucket_name: str, manifest: Dict[str, dict]) -> None:
+    """
+    Write the ingest manifest to S3, overwriting the previous one.
 
-    # Upload to S3 (overwriting the existing file)
-    s3_client = boto3.client("s3")
-    s3_client.put_object(
-        Bucket=bucket_name, Key=config["ingest_cache_file"], Body=content
+    Args:
+        bucket_name (str): Name of the S3 bucket
+        manifest (Dict[str, dict]): Manifest entries keyed by S3 URI
+    """
+    key = config.get("ingest_manifest_file", "ingest_manifest.json")
+    boto3.client("s3").put_object(
+        Bucket=bucket_name,
+        Key=key,
+        Body=json.dumps(manifest, sort_keys=True),
+        ContentType="application/json",
     )
+    print(f"\nIngest manifest updated: s3://{bucket_name}/{key}")
+    print(f"Total ingested files: {len(manifest)}")
+
+
+def diff_manifest(
+    manifest: Dict[str, dict], objects: Dict[str, dict]
+) -> Tuple[List[str], List[str], List[str]]:
+    """
+    Compare the ingest manifest with the PDFs now in S3.
+
+    Args:
+        manifest (Dict[str, dict]): Manifest entries keyed by S3 URI
+        objects (Dict[str, dict]): ETag and size of each PDF, keyed by S3 URI
 
-    cache_file = config["ingest_cache_file"]
-    print(f"\nSuccessful URIs file updated: s3://{bucket_name}/{cache_file}")
-    print(f"Total successful files: {len(all_successful_list)}")
+    Returns:
+        Tuple[List[str], List[str], List[str]]: URIs of the PDFs added,
+            changed and deleted since they were last ingested
+    """
+    added = [uri for uri in objects if uri not in manifest]
+    updated = [
+        uri
+        for uri in objects
+        if uri in manifest
+        and (manifest[uri]["etag"], manifest[uri]["size"])
+        != (objects[uri]["etag"], objects[uri]["size"])
+    ]
+    deleted = [uri for uri in manifest if uri not in objects]
+    return added, updated, deleted
 
 
-async def invoke_lambda(session, uri):
+async def invoke_lambda(session, uri, previous_content_hash=None):
     """
     Invoke Lambda function for a single URI.
 
     Args:
         session: aioboto3 session
         uri (str): URI to process
+        previous_content_hash (str): Content hash the document was last
+            ingested with, if it was
 
     Returns:
-        dict: Result with URI and success status
+        dict: Result with URI, success status, and for a success the
+            document's content hash and chunk ids
     """
     # Extract filename from URI for cleaner display
     filename = os.path.basename(uri)
@@ -154,6 +215,7 @@ async def invoke_lambda(session, uri):
                         "image_model_id": config["model"]["image"],
                         "embedding_model_id": config["model"]["embedding"],
                         "opensearch_index": config["opensearch_index_name"],
+                        "previous_content_hash": previous_content_hash,
                     }
                 ).encode(),
             )
@@ -163,16 +225,82 @@ async def invoke_lambda(session, uri):
 
             status_code = result.get("statusCode")
 
-            if status_code == 200:
+            failed_chunks = result.get("indexing", {}).get("failed", 0)
+            if status_code == 200 and not failed_chunks:
                 print(f"✅ {filename}")
                 if "body" in result:
                     print(f"   {result['body']}")
-                return {"uri": uri, "success": True}
+                return {
+                    "uri": uri,
+                    "success": True,
+                    "unchanged": result.get("unchanged", False),
+                    "content_hash": result.get("content_hash"),
+                    "chunk_ids": result.get("chunk_ids", []),
+                    "image_cache": result.get("image_cache"),
+                }
+            elif status_code == 200:
+                # Retried on the next run, the previous version stays indexed
+                print(f"⚠️ {filename} ({failed_chunks} chunks failed)")
+                if "body" in result:
+                    print(f"   {result['body']}")
+                return {
+                    "uri": uri,
+                    "success": False,
+                    "image_cache": result.get("image_cache"),
+                }
             else:
                 print(f"❌ {filename} (Status: {status_code})")
                 if "body" in result:
                     print(f"   Error: {result['body']}")
-                return {"uri": uri, "success": False}
+                return {
+                    "uri": uri,
+                    "success": False,
+                    "image_cache": result.get("image_cache"),
+                }
+
+        except Exception as e:
+            print(f"❌ {filename} (Exception)")
+            print(f"   Error: {str(e)}")
+            return {"uri": uri, "success": False}
+
+
+async def delete_document(session, uri):
+    """
+    Invoke the Lambda function to remove the chunks of a deleted document.
+
+    Args:
+        session: aioboto3 session
+        uri (str): URI of the deleted document
+
+    Returns:
+        dict: Result with URI and success status
+    """
+    filename = os.path.basename(uri)
+
+    async with session.client("lambda", config=timeout_config) as lambda_client:
+        try:
+            response = await lambda_client.invoke(
+                FunctionName=function_name,
+                InvocationType="RequestResponse",
+                Payload=json.dumps(
+                    {
+                        "action": "delete",
+                        "uri": uri,
+                        "opensearch_index": config["opensearch_index_name"],
+                    }
+                ).encode(),
+            )
+
+            payload = await response["Payload"].read()
+            result = json.loads(payload)
+
+            if result.get("statusCode") == 200:
+                print(f"🗑️ {filename} ({result.get('deleted', 0)} chunks deleted)")
+                return {"uri": uri, "success": True}
+            print(f"❌ {filename} (Status: {result.get('statusCode')})")
+            if "body" in result:
+                print(f"   Error: {result['body']}")
+            return {"uri": uri, "success": False}
 
         except Exception as e:
             print(f"❌ {filename} (Exception)")
@@ -186,48 +314,98 @@ async def main():
     print(f" PDF INGESTION PROCESS - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
     print("=" * 80)
 
-    # Get previously processed URIs
-    previously_processed = get_previously_processed_uris(config["input_bucket_name"])
+    bucket_name = config["input_bucket_name"]
+
+    # Get the documents ingested so far
+    manifest = load_manifest(bucket_name)
 
     # Get all PDF files from S3
-    all_uris = list_s3_pdfs(config["input_bucket_name"], config["file_input_folder"])
-    print(f"\nFound {len(all_uris)} total PDF files")
+    objects = list_s3_pdf_objects(bucket_name, config["file_input_folder"])
+    print(f"\nFound {len(objects)} total PDF files")
+
+    # Documents from the ingest cache file are taken as they are now
+    migrated = [
+        uri
+        for uri, entry in manifest.items()
+        if entry["etag"] is None and uri in objects
+    ]
+    for uri in migrated:
+        manifest[uri].update(objects[uri])
 
-    # Filter out previously processed URIs
-    uris_to_process = [uri for uri in all_uris if uri not in previously_processed]
-    print(f"Found {len(uris_to_process)} new PDF files to process")
+    # Compare against the manifest
+    added, updated, deleted = diff_manifest(manifest, objects)
+    print(
+        f"Found {len(added)} new, {len(updated)} changed and {len(deleted)} "
+        "deleted PDF files"
+    )
 
-    # If no new files to process, exit early
-    if not uris_to_process:
-        print("\nNo new files to process. Exiting.")
+    # If nothing changed, exit early
+    if not (added or updated or deleted):
+        if migrated:
+            save_manifest(bucket_name, manifest)
+        print("\nNo new, changed or deleted files. Exiting.")
         return
 
     # Check/create index
     check_create_index(config["opensearch_index_name"])
+    if config.get("retrieval_mode") == "pipeline":
+        check_create_search_pipeline(config["search_pipeline_name"])
     print(f"OpenSearch index '{config['opensearch_index_name']}' ready\n")
     print("-" * 80)
 
-    # Process files
+    # Remove the chunks of deleted files, failures are retried on the next run
+    delete_results = await asyncio.gather(
+        *(delete_document(aioboto3.Session(), uri) for uri in deleted)
+    )
+    for result in delete_results:
+        if result["success"]:
+            del manifest[result["uri"]]
+
+    # Process new and changed files, changed ones replace their chunks
+    uris_to_process = added + updated
     async with aioboto3.Session().client("lambda") as lambda_client:
-        tasks = [invoke_lambda(aioboto3.Session(), uri) for uri in uris_to_process]
+        tasks = [
+            invoke_lambda(
+                aioboto3.Session(), uri, manifest.get(uri, {}).get("content_hash")
+            )
+            for uri in uris_to_process
+        ]
         results = await asyncio.gather(*tasks)
 
-    # Filter for successful URIs only
-    newly_successful_uris = [
-        result["uri"] for result in results if result.get("success")
-    ]
+    # Record successful files in the manifest
+    for result in results:
+        if not result.get("success"):
+            continue
+        uri = result["uri"]
+        if result["unchanged"]:
+            chunk_ids = manifest[uri]["chunk_ids"]
+        else:
+            chunk_ids = result["chunk_ids"]
+        manifest[uri] = {
+            **objects[uri],
+            "content_hash": result["content_hash"],
+            "chunk_ids": chunk_ids,
+        }
 
-    # Update the successful URIs file in S3
-    update_successful_uris(
-        config["input_bucket_name"], newly_successful_uris, previously_processed
-    )
+    save_manifest(bucket_name, manifest)
 
     # Print summary
-    success_count = len(newly_successful_uris)
+    success_count = sum(1 for result in results if result.get("success"))
+    removed_count = sum(1 for result in delete_results if result["success"])
     print("\n" + "-" * 80)
     print(
-        f"SUMMARY: {success_count}/{len(uris_to_process)} new files processed successfully"
+        f"SUMMARY: {success_count}/{len(uris_to_process)} new or changed files "
+        f"processed successfully, {removed_count}/{len(deleted)} deleted files "
+        "removed"
     )
+
+    image_stats = [result["image_cache"] for result in results if result.get("image_cache")]
+    hits = sum(stats["hits"] for stats in image_stats)
+    lookups = hits + sum(stats["misses"] for stats in image_stats)
+    if lookups:
+        print(
+            f"IMAGE CACHE: {hits}/{lookups} images reused ({hits / lookups:.0%} hit rate)"
+        )
     print("=" * 80 + "\n")
 
 